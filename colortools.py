@@ -0,0 +1,157 @@
+"""
+Color replacement shared by the editor (main.py) and original.py.
+
+Every pixel gets a distance to the source color, in RGB or in Lab, and is moved towards
+the target color by a weight of 1 inside the tolerance, fading to 0 across the softness band.
+Moving by the difference of the two colors (instead of painting the target over the pixel)
+keeps shading and the anti-aliased edges where the source color blends into its neighbours.
+"""
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageChops
+
+COLOR_SPACES = ("rgb", "lab")
+# In Lab, candidate pixels are narrowed down with a cube of RGB colors quantized to this many levels per channel
+LAB_CUBE_LEVELS = 64
+LAB_CUBE_STEP = 256 // LAB_CUBE_LEVELS
+
+
+# sRGB (D65) to CIE XYZ, and the D65 white point
+RGB_TO_XYZ = np.array(((0.4124564, 0.3575761, 0.1804375),
+                       (0.2126729, 0.7151522, 0.0721750),
+                       (0.0193339, 0.1191920, 0.9503041)), dtype=np.float32)
+WHITE_XYZ = np.array((0.95047, 1.0, 1.08883), dtype=np.float32)
+SRGB_LEVELS = np.arange(256, dtype=np.float32) / 255
+SRGB_TO_LINEAR = np.where(SRGB_LEVELS <= 0.04045, SRGB_LEVELS / 12.92,
+                          ((SRGB_LEVELS + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+
+def _colors_to_lab(colors):
+    # Lab of an N x 3 uint8 array of colors, in float so nearby colors stay apart
+    xyz = SRGB_TO_LINEAR[np.asarray(colors).reshape(-1, 3)] @ (RGB_TO_XYZ.T / WHITE_XYZ)
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack((116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])), axis=1)
+
+
+@lru_cache(maxsize=1)
+def _lab_cube():
+    """
+    Lab of the center of every cell of the quantized RGB cube, indexed [r, g, b], and the
+    furthest any corner of the cell lies from that center, so a cell can be ruled out safely.
+    """
+    levels = np.arange(LAB_CUBE_LEVELS, dtype=np.uint8) * LAB_CUBE_STEP + LAB_CUBE_STEP // 2
+    r, g, b = np.meshgrid(levels, levels, levels, indexing="ij")
+    centers = _colors_to_lab(np.stack((r, g, b), axis=-1)).reshape((LAB_CUBE_LEVELS,) * 3 + (3,))
+
+    edges = np.minimum(np.arange(LAB_CUBE_LEVELS + 1) * LAB_CUBE_STEP, 255).astype(np.uint8)
+    r, g, b = np.meshgrid(edges, edges, edges, indexing="ij")
+    corners = _colors_to_lab(np.stack((r, g, b), axis=-1)).reshape((LAB_CUBE_LEVELS + 1,) * 3 + (3,))
+    radius = np.zeros((LAB_CUBE_LEVELS,) * 3, dtype=np.float32)
+    n = LAB_CUBE_LEVELS
+    for dr in (0, 1):
+        for dg in (0, 1):
+            for db in (0, 1):
+                corner = corners[dr:dr + n, dg:dg + n, db:db + n]
+                radius = np.maximum(radius, np.sqrt(((corner - centers) ** 2).sum(axis=-1)))
+    return centers, radius
+
+
+@lru_cache(maxsize=8)
+def _lab_cube_bound(source):
+    # Lowest Delta E any color of each cell can have to source
+    centers, radius = _lab_cube()
+    source_lab = _colors_to_lab(np.asarray([source], dtype=np.uint8))[0]
+    return np.sqrt(((centers - source_lab) ** 2).sum(axis=-1)) - radius
+
+
+def channel_ranges(source, reach, space="rgb"):
+    # Per channel (low, high) that any pixel within reach of source has to lie in
+    if space == "rgb":
+        return [(max(0, int(c - reach)), min(255, int(c + reach + 1))) for c in source]
+    cells = np.nonzero(_lab_cube_bound(tuple(source)) <= reach)
+    if len(cells[0]) == 0:
+        return None
+    return [(int(c.min()) * LAB_CUBE_STEP, int(c.max()) * LAB_CUBE_STEP + LAB_CUBE_STEP - 1) for c in cells]
+
+
+def pixel_distances(pixels, source, space="rgb"):
+    """
+    Distance of each row of an N x 3 uint8 array to source: Euclidean in 0-255 units per
+    channel for RGB, Delta E (CIE76) for Lab.
+    """
+    if space == "rgb":
+        diff = pixels.astype(np.int32) - np.asarray(source, dtype=np.int32)
+        return np.sqrt((diff * diff).sum(axis=1).astype(np.float32))
+    source_lab = _colors_to_lab(np.asarray([source], dtype=np.uint8))[0]
+    return np.sqrt(((_colors_to_lab(pixels) - source_lab) ** 2).sum(axis=1))
+
+
+def distance_weights(distance, tolerance=0.0, softness=0.0):
+    # 1 within tolerance, falling linearly to 0 over the next softness units
+    if softness <= 0:
+        return (distance <= tolerance).astype(np.float32)
+    return np.clip((tolerance + softness - distance) / softness, 0, 1).astype(np.float32)
+
+
+def move_colors(colors, candidates, source, target, tolerance=0.0, space="rgb", softness=0.0):
+    # Moves the candidate rows of an N x 3 uint8 array towards target in place, False if none moved
+    weights = distance_weights(pixel_distances(colors[candidates], source, space), tolerance, softness)
+    moving = candidates[weights > 0]
+    weights = weights[weights > 0]
+    if len(moving) == 0:
+        return False
+    shift = np.asarray(target, dtype=np.float32) - np.asarray(source, dtype=np.float32)
+    moved = colors[moving].astype(np.float32) + weights[:, None] * shift
+    colors[moving] = np.clip(moved + 0.5, 0, 255).astype(np.uint8)
+    return True
+
+
+def replace_palette_color(img, source, target, tolerance=0.0, space="rgb", softness=0.0):
+    # A palette image only needs its palette entries moved, its pixels keep their indices
+    palette = np.array(img.getpalette("RGB"), dtype=np.uint8).reshape(-1, 3)
+    result = img.copy()
+    if move_colors(palette, np.arange(len(palette)), source, target, tolerance, space, softness):
+        result.putpalette(palette.tobytes(), "RGB")
+    return result
+
+
+def replace_color(img, source, target, tolerance=0.0, space="rgb", softness=0.0):
+    """
+    Copy of img with source moved to target. With tolerance and softness 0 only exact
+    matches change, like the old pixel loop did. Alpha, if any, is left alone.
+    """
+    if space not in COLOR_SPACES:
+        raise ValueError(f"unknown color space {space!r}, expected one of {COLOR_SPACES}")
+    if img.mode == "P":
+        return replace_palette_color(img, source, target, tolerance, space, softness)
+    alpha = img.getchannel("A") if img.mode in ("RGBA", "LA") else None
+    rgb_img = img if img.mode == "RGB" else img.convert("RGB")
+
+    # Pillow narrows the search to pixels inside the per-channel ranges, a pass over bytes in C.
+    # Only those candidates, usually a small part of a photo, get an exact distance in numpy.
+    ranges = channel_ranges(source, tolerance + max(softness, 0), space)
+    if ranges is None:
+        return img.copy()
+    masks = [band.point([255 if low <= v <= high else 0 for v in range(256)])
+             for band, (low, high) in zip(rgb_img.split(), ranges)]
+    mask = ImageChops.darker(ImageChops.darker(masks[0], masks[1]), masks[2])
+    box = mask.getbbox()
+    if box is None:
+        return img.copy()
+
+    region = np.array(rgb_img.crop(box))
+    flat = region.reshape(-1, 3)
+    candidates = np.flatnonzero(np.asarray(mask.crop(box)))
+    if not move_colors(flat, candidates, source, target, tolerance, space, softness):
+        return img.copy()
+
+    result = rgb_img.copy()
+    result.paste(Image.fromarray(region), box[:2])
+    if alpha is not None:
+        result.putalpha(alpha)
+        if img.mode == "LA":
+            result = result.convert("LA")
+    elif img.mode not in ("RGB", "L"):
+        result = result.convert(img.mode)
+    return result
@@ -1,15 +1,74 @@
+import time
+_STARTUP_START = time.perf_counter()  # taken before the heavier imports so they show up in the startup report
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from PIL import Image, ImageTk, ImageEnhance, ImageFilter, ImageOps, ImageDraw
-import cv2
+from tkinter import filedialog, messagebox, simpledialog, ttk
+from PIL import Image, ImageTk, ImageChops, ImageColor, ImageEnhance, ImageFilter, ImageOps, ImageDraw, ImageFont
 import os
+import atexit
 import copy
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import pickle
+import platform
+import queue
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor, wait
+
+logger = logging.getLogger("photoeditor")
+
+LAST_SESSION_PATH = "last_session_image.jpg"
+STARTUP_TARGET_MS = 300
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".photoeditor", "cache")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def atomic_write(path, data):
+    """
+    Write data (str, bytes, or a list of bytes chunks written in order) to path, creating
+    its directory. It goes to a temporary file first and is renamed into place, so a
+    reader on another thread or process never sees half a file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chunks = data if isinstance(data, list) else [data]
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w" if isinstance(data, str) else "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(temp_path, path)
+
+
+_cv2 = None
+
+
+def load_cv2():
+    # OpenCV costs more to import than the rest of the app together, so it waits until the webcam is used
+    global _cv2
+    if _cv2 is None:
+        import cv2
+        _cv2 = cv2
+    return _cv2
 
 
 #-----------------------------
 # UTILITY
 #-----------------------------
 
+def same_objects(a, b):
+    # Whether two sequences hold the very same objects, in order (no value comparison)
+    return a is not None and b is not None and len(a) == len(b) and all(x is y for x, y in zip(a, b))
+
+
 class ToolTip:
     def __init__(self, widget, text):
         self.widget = widget
@@ -53,8 +112,1910 @@ class ToolTip:
         self.hide_tip()
 
 
+class HistogramPanel:
+    def __init__(self, parent, width=256, height=80):
+        self.width = width
+        self.height = height
+        self.frame = tk.Frame(parent)
+        self.canvas = tk.Canvas(self.frame, width=width, height=height, bg="black", highlightthickness=0)
+        self.canvas.pack(side="top")
+        self.stats_label = tk.Label(self.frame, text="", font=("Arial", 8))
+        self.stats_label.pack(side="top")
+
+        # One item per channel, created once and only moved with coords() afterwards
+        flat = [0, height, width, height]
+        self.items = {
+            "luminance": self.canvas.create_polygon(*flat, fill="gray40", outline=""),
+            "red": self.canvas.create_line(*flat, fill="red"),
+            "green": self.canvas.create_line(*flat, fill="green2"),
+            "blue": self.canvas.create_line(*flat, fill="DodgerBlue"),
+        }
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def update(self, stats):
+        # Scale to the tallest interior bin so clipped shadows/highlights don't flatten the curve
+        peak = max(max(stats[name][1:255]) for name in self.items) or 1
+        step = self.width / 255
+        for name, item in self.items.items():
+            points = []
+            for value, count in enumerate(stats[name]):
+                points.extend((value * step, self.height - min(count / peak, 1.0) * self.height))
+            if name == "luminance":
+                points = [0, self.height] + points + [self.width, self.height]
+            self.canvas.coords(item, *points)
+
+        pixels = stats["pixels"]
+        means = [histogram_mean(stats[name]) for name in ("red", "green", "blue")]
+        shadows = 100 * stats["luminance"][0] / pixels
+        highlights = 100 * stats["luminance"][255] / pixels
+        self.stats_label.config(
+            text=f"Mean R {means[0]:.0f}  G {means[1]:.0f}  B {means[2]:.0f}  |  "
+                 f"Clipped {shadows:.1f}% / {highlights:.1f}%"
+        )
+
+
+class FilmstripPanel:
+    """
+    Horizontal strip of folder thumbnails. Only the visible cells (plus a margin) are
+    requested, and a few worker threads produce them newest request first, so scrolling
+    never waits on decoding.
+    """
+
+    def __init__(self, parent, on_select, thumb_size=None, workers=None):
+        self.on_select = on_select
+        self.thumb_size = thumb_size or THUMBNAIL_SIZE
+        self.workers = workers or THUMBNAIL_WORKERS
+        self.cell = self.thumb_size + 8
+        self.frame = tk.Frame(parent)
+        self.canvas = tk.Canvas(self.frame, height=self.cell + 14, bg="gray20", highlightthickness=0,
+                                xscrollincrement=self.cell)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="horizontal", command=self.on_scroll)
+        self.canvas.config(xscrollcommand=self.scrollbar.set)
+        self.canvas.pack(side="top", fill="x")
+        self.scrollbar.pack(side="top", fill="x")
+
+        self.canvas.bind("<Configure>", lambda event: self.request_visible())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
+
+        self.paths = []
+        self.image_items = []
+        self.photos = {}  # index -> PhotoImage, Tk drops images that aren't referenced
+        self.requested = set()
+        self.generation = 0  # bumped per folder so stale results are dropped
+        self.pending = 0
+        self.jobs = queue.LifoQueue()
+        self.results = queue.Queue()
+        self.threads_started = False
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def show_folder(self, folder):
+        if not self.threads_started:
+            for _ in range(self.workers):
+                threading.Thread(target=self.worker, daemon=True).start()
+            self.threads_started = True
+
+        self.generation += 1
+        self.paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                      if name.lower().endswith(IMAGE_EXTENSIONS)]
+        self.image_items = []
+        self.photos.clear()
+        self.requested.clear()
+        self.pending = 0
+        self.canvas.delete("all")
+
+        for index, path in enumerate(self.paths):
+            x = index * self.cell + 4
+            self.canvas.create_rectangle(x, 4, x + self.thumb_size, 4 + self.thumb_size, fill="gray30", width=0)
+            self.image_items.append(self.canvas.create_image(x + self.thumb_size // 2, 4 + self.thumb_size // 2))
+            self.canvas.create_text(x + self.thumb_size // 2, self.cell + 4, text=os.path.basename(path)[:14],
+                                    fill="white", font=("Arial", 7))
+        self.canvas.config(scrollregion=(0, 0, len(self.paths) * self.cell, self.cell + 14))
+        self.canvas.xview_moveto(0)
+        self.request_visible()
+
+    def on_scroll(self, *args):
+        self.canvas.xview(*args)
+        self.request_visible()
+
+    def on_mouse_wheel(self, event):
+        step = -3 if (event.num == 4 or event.delta > 0) else 3
+        self.canvas.xview_scroll(step, "units")
+        self.request_visible()
+
+    def on_click(self, event):
+        index = int(self.canvas.canvasx(event.x) // self.cell)
+        if 0 <= index < len(self.paths):
+            self.on_select(self.paths[index])
+
+    def request_visible(self):
+        if not self.paths:
+            return
+        left = self.canvas.canvasx(0)
+        right = self.canvas.canvasx(max(self.canvas.winfo_width(), 1))
+        # a screen's worth of margin on each side so short scrolls find them ready
+        margin = int((right - left) // self.cell) + 1
+        first = max(0, int(left // self.cell) - margin)
+        last = min(len(self.paths), int(right // self.cell) + 1 + margin)
+        had_pending = self.pending
+        for index in range(first, last):
+            if index not in self.requested:
+                self.requested.add(index)
+                self.pending += 1
+                self.jobs.put((self.generation, index, self.paths[index]))
+        if self.pending and not had_pending:
+            self.canvas.after(15, self.poll_results)
+
+    def worker(self):
+        while True:
+            generation, index, path = self.jobs.get()
+            if generation != self.generation:
+                continue
+            try:
+                thumb = load_thumbnail(path, self.thumb_size)
+            except Exception:
+                # not only OSError: a decompression bomb or a broken header raises others, and
+                # the result still has to be posted or pending never gets back to 0
+                thumb = None
+            self.results.put((generation, index, thumb))
+
+    def poll_results(self):
+        # PhotoImages must be made on the Tk thread; a bounded batch keeps each tick short
+        for _ in range(40):
+            try:
+                generation, index, thumb = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                continue
+            self.pending -= 1
+            if thumb is not None:
+                self.photos[index] = ImageTk.PhotoImage(thumb)
+                self.canvas.itemconfig(self.image_items[index], image=self.photos[index])
+        if self.pending:
+            self.canvas.after(15, self.poll_results)
+
+
+class FilterGalleryPanel:
+    def __init__(self, parent, on_select, thumb_size=None):
+        self.on_select = on_select
+        self.thumb_size = thumb_size or GALLERY_PROXY_SIZE
+        self.cell = self.thumb_size + 8
+        self.frame = tk.Frame(parent)
+        self.canvas = tk.Canvas(self.frame, width=600, height=self.cell + 12, highlightthickness=0,
+                                xscrollincrement=self.cell)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="horizontal", command=self.canvas.xview)
+        self.canvas.config(xscrollcommand=self.scrollbar.set)
+        self.canvas.pack(side="top")
+        self.scrollbar.pack(side="top", fill="x")
+        self.canvas.bind("<Button-1>", self.on_click)
+
+        self.photos = []
+        self.image_items = []
+        self.frames = []
+        for index, states in enumerate(FILTER_COMBINATIONS):
+            x = index * self.cell + 4
+            self.frames.append(self.canvas.create_rectangle(x - 2, 2, x + self.thumb_size + 2, self.thumb_size + 6,
+                                                            outline="", width=2))
+            self.image_items.append(self.canvas.create_image(x + self.thumb_size // 2, 4 + self.thumb_size // 2))
+            self.canvas.create_text(x + self.thumb_size // 2, self.cell + 3, text=filter_combination_label(states),
+                                    font=("Arial", 7))
+        self.canvas.config(scrollregion=(0, 0, len(FILTER_COMBINATIONS) * self.cell, self.cell + 12))
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def show(self, previews):
+        self.photos = [ImageTk.PhotoImage(preview) for preview in previews]
+        for item, photo in zip(self.image_items, self.photos):
+            self.canvas.itemconfig(item, image=photo)
+
+    def highlight(self, filter_states):
+        for item, states in zip(self.frames, FILTER_COMBINATIONS):
+            self.canvas.itemconfig(item, outline="blue" if states == filter_states else "")
+
+    def on_click(self, event):
+        index = int(self.canvas.canvasx(event.x) // self.cell)
+        if 0 <= index < len(FILTER_COMBINATIONS):
+            self.on_select(FILTER_COMBINATIONS[index])
+
+
+#-----------------------------
+# THUMBNAILS
+#-----------------------------
+
+THUMBNAIL_SIZE = 96
+THUMBNAIL_WORKERS = max(2, min(8, (os.cpu_count() or 2)))
+THUMBNAIL_CACHE_DIR = os.path.join(CACHE_DIR, "thumbnails")
+
+
+def thumbnail_cache_key(path):
+    # Any rewrite of the file changes its mtime or size, which retires the old entry
+    st = os.stat(path)
+    ident = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+    return hashlib.sha1(ident.encode("utf-8")).hexdigest()
+
+
+def load_thumbnail(path, size=THUMBNAIL_SIZE, cache_dir=THUMBNAIL_CACHE_DIR):
+    cache_path = os.path.join(cache_dir, thumbnail_cache_key(path) + ".jpg")
+    try:
+        with Image.open(cache_path) as cached:
+            cached.load()
+            return cached.copy()
+    except OSError:
+        pass
+
+    with Image.open(path) as img:
+        # JPEGs decode straight at 1/2, 1/4 or 1/8 scale, the full frame is never built
+        img.draft("RGB", (size, size))
+        img.thumbnail((size, size))
+        thumb = img.convert("RGB")
+
+    encoded = io.BytesIO()
+    thumb.save(encoded, "JPEG", quality=85)
+    atomic_write(cache_path, encoded.getvalue())
+    return thumb
+
+
+#-----------------------------
+# PROCESSING BACKENDS
+#-----------------------------
+
+# Every pixel operation of the edit pipeline has a Pillow and an OpenCV version. Which one
+# runs is decided per operation and image size by autotune_backends on this machine.
+BACKEND_TUNING_PATH = os.path.join(os.path.dirname(CACHE_DIR), "backends.json")
+# (largest image in pixels, benchmark size) per size class, the last one takes everything bigger
+BACKEND_SIZE_CLASSES = ((1_000_000, (1000, 750)), (6_000_000, (2800, 2100)), (None, (3600, 2400)))
+# (max, mean) absolute difference to Pillow that OpenCV may show and still count as equivalent.
+# Blur gets some room for the different kernel (Pillow stacks box blurs, OpenCV is a true
+# Gaussian); resize is held to the same bar, so OpenCV's area downscale only wins where it
+# really gives the same picture
+BACKEND_TOLERANCE = {"blur": (8, 0.5), "resize": (8, 0.5)}
+BACKEND_DEFAULT_TOLERANCE = (1, 0.05)
+BACKEND_TUNING_VERSION = 2  # part of the fingerprint, bumped when what a tuning measures changes
+RESIZE_TUNED_REDUCTION = (2, 4)  # reductions around the benchmark's third that its choice covers
+RESIZE_REDUCING_GAP = 2.0  # mean difference to a plain Lanczos resize stays around 0.2
+
+# pip packages OpenCV may be installed from, read for the version without importing cv2
+OPENCV_DISTRIBUTIONS = ("opencv-python", "opencv-python-headless", "opencv-contrib-python",
+                        "opencv-contrib-python-headless")
+
+_backend_choices = {}  # op -> ((largest image in pixels, backend name), ...), Pillow when missing
+_backend_tuning_due = False  # no valid tuning saved, measured the first time an op could use OpenCV
+_backend_tuning_lock = threading.Lock()
+
+
+def pillow_grayscale(img):
+    return img.convert("L").convert("RGB")
+
+
+def pillow_sepia(img):
+    return img.convert("RGB", SEPIA_MATRIX)
+
+
+def pillow_invert(img):
+    return ImageOps.invert(img)
+
+
+def pillow_blur(img, radius):
+    return img.filter(ImageFilter.GaussianBlur(radius))
+
+
+def pillow_rotate(img, angle):
+    return img.rotate(angle, expand=True)
+
+
+def pillow_flip(img, direction):
+    if direction == "vertical":
+        return img.transpose(Image.FLIP_TOP_BOTTOM)
+    return img.transpose(Image.FLIP_LEFT_RIGHT)
+
+
+def pillow_resize(img, size):
+    # big reductions start with reduce(), which costs a fraction of Lanczos over every source pixel
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+
+
+def opencv_grayscale(img):
+    import numpy as np
+    cv2 = load_cv2()
+    gray = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2GRAY)
+    return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
+
+
+def opencv_sepia(img):
+    import numpy as np
+    cv2 = load_cv2()
+    # the -0.5 offsets in SEPIA_MATRIX already account for rounding, so +0.5 and truncate
+    out = cv2.transform(np.asarray(img, dtype=np.float32), np.array(SEPIA_MATRIX, dtype=np.float32).reshape(3, 4))
+    return Image.fromarray(np.clip(out + 0.5, 0, 255).astype(np.uint8))
+
+
+def opencv_invert(img):
+    import numpy as np
+    return Image.fromarray(load_cv2().bitwise_not(np.asarray(img)))
+
+
+def opencv_blur(img, radius):
+    import numpy as np
+    if radius <= 0:
+        return img.copy()
+    return Image.fromarray(load_cv2().GaussianBlur(np.asarray(img), (0, 0), radius))
+
+
+def opencv_rotate(img, angle):
+    import numpy as np
+    cv2 = load_cv2()
+    if angle % 90:
+        return pillow_rotate(img, angle)
+    turns = quarter_turns(angle)
+    if turns == 0:
+        return img.copy()
+    codes = {1: cv2.ROTATE_90_COUNTERCLOCKWISE, 2: cv2.ROTATE_180, 3: cv2.ROTATE_90_CLOCKWISE}
+    return Image.fromarray(cv2.rotate(np.asarray(img), codes[turns]))
+
+
+def opencv_flip(img, direction):
+    import numpy as np
+    return Image.fromarray(load_cv2().flip(np.asarray(img), 0 if direction == "vertical" else 1))
+
+
+def opencv_resize(img, size):
+    import numpy as np
+    cv2 = load_cv2()
+    # area averaging is OpenCV's alias-free downscale, its Lanczos only suits enlarging
+    interpolation = cv2.INTER_AREA if size[0] < img.size[0] else cv2.INTER_LANCZOS4
+    return Image.fromarray(cv2.resize(np.asarray(img), size, interpolation=interpolation))
+
+
+def resize_reduction_tuned(img, size):
+    return RESIZE_TUNED_REDUCTION[0] <= img.size[0] / max(1, size[0]) <= RESIZE_TUNED_REDUCTION[1]
+
+
+# op -> (implementations, modes the OpenCV version handles, benchmark arguments for an image size,
+# whether the benchmark's verdict covers a call's arguments or None when they never matter).
+# Outside what was measured the output may differ more, so those calls stay on Pillow
+BACKEND_OPS = {
+    "grayscale": ({"pillow": pillow_grayscale, "opencv": opencv_grayscale}, ("RGB",), lambda size: (), None),
+    "sepia": ({"pillow": pillow_sepia, "opencv": opencv_sepia}, ("RGB",), lambda size: (), None),
+    "invert": ({"pillow": pillow_invert, "opencv": opencv_invert}, ("RGB",), lambda size: (), None),
+    "blur": ({"pillow": pillow_blur, "opencv": opencv_blur}, ("L", "RGB", "RGBA"), lambda size: (BLUR_RADIUS,),
+             lambda img, radius: radius == BLUR_RADIUS),
+    "rotate": ({"pillow": pillow_rotate, "opencv": opencv_rotate}, ("L", "RGB", "RGBA"), lambda size: (90,), None),
+    "flip": ({"pillow": pillow_flip, "opencv": opencv_flip}, ("L", "RGB", "RGBA"), lambda size: ("horizontal",),
+             None),
+    "resize": ({"pillow": pillow_resize, "opencv": opencv_resize}, ("L", "RGB", "RGBA"),
+               lambda size: ((size[0] // 3, size[1] // 3),), resize_reduction_tuned),
+}
+
+
+def choose_backend(op, img, *args):
+    implementations, opencv_modes, _, tuned = BACKEND_OPS[op]
+    if img.mode not in opencv_modes or (tuned is not None and not tuned(img, *args)):
+        return "pillow"
+    if _backend_tuning_due:
+        start_backend_tuning()
+    pixels = img.size[0] * img.size[1]
+    for limit, backend in _backend_choices.get(op, ()):
+        if limit is None or pixels <= limit:
+            return backend
+    return "pillow"
+
+
+def run_op(op, img, *args):
+    return BACKEND_OPS[op][0][choose_backend(op, img, *args)](img, *args)
+
+
+def opencv_version():
+    # The installed OpenCV's version from its package metadata, None without OpenCV
+    from importlib import metadata
+    for name in OPENCV_DISTRIBUTIONS:
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            pass
+    return None
+
+
+def backend_fingerprint():
+    # a tuning only holds for the machine and library versions it was measured with
+    import PIL
+    return {"machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count(),
+            "pillow": PIL.__version__, "opencv": opencv_version(), "version": BACKEND_TUNING_VERSION}
+
+
+def backend_difference(a, b):
+    # (max, mean) absolute pixel difference of two images of the same size and mode
+    import numpy as np
+    diff = np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16))
+    return int(diff.max()), float(diff.mean())
+
+
+def benchmark_image(size):
+    # gradients, soft texture and hard edges, roughly what a photo holds, in a fixed pattern
+    gradient = Image.linear_gradient("L").resize(size)
+    texture = Image.effect_noise(size, 40).filter(ImageFilter.BoxBlur(2))
+    img = Image.merge("RGB", (gradient, texture, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(img)
+    for i in range(8):
+        x, y = size[0] * i // 8, size[1] * ((i * 3) % 8) // 8
+        draw.rectangle((x, y, x + size[0] // 10, y + size[1] // 10), fill=(255 - 30 * i, 30 * i, 128))
+    return img
+
+
+def time_op(func, img, args, repeats=2):
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        out = func(img, *args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def autotune_backends(path=BACKEND_TUNING_PATH):
+    """
+    Time both backends of every op at each size class and keep the faster one, OpenCV
+    only where its output matches Pillow's within BACKEND_TOLERANCE. The result is saved
+    to path with the machine fingerprint and becomes the active choice.
+    """
+    global _backend_choices
+    choices = {}
+    report = {}
+    for op, (implementations, _, benchmark_args, _) in BACKEND_OPS.items():
+        choices[op] = []
+        for limit, size in BACKEND_SIZE_CLASSES:
+            img = benchmark_image(size)
+            op_args = benchmark_args(size)
+            pillow_time, expected = time_op(implementations["pillow"], img, op_args)
+            opencv_time, out = time_op(implementations["opencv"], img, op_args)
+            tolerance = BACKEND_TOLERANCE.get(op, BACKEND_DEFAULT_TOLERANCE)
+            max_diff, mean_diff = backend_difference(expected, out)
+            equivalent = max_diff <= tolerance[0] and mean_diff <= tolerance[1]
+            backend = "opencv" if equivalent and opencv_time < pillow_time else "pillow"
+            choices[op].append((limit, backend))
+            report.setdefault(op, []).append({
+                "pixels": size[0] * size[1], "pillow_ms": round(pillow_time * 1000, 2),
+                "opencv_ms": round(opencv_time * 1000, 2), "max_diff": max_diff,
+                "mean_diff": round(mean_diff, 4), "equivalent": equivalent, "backend": backend})
+
+    atomic_write(path, json.dumps({"fingerprint": backend_fingerprint(), "choices": choices, "report": report},
+                                  indent=1))
+    _backend_choices = {op: tuple(tuple(c) for c in entries) for op, entries in choices.items()}
+    return report
+
+
+def load_backend_tuning(path=BACKEND_TUNING_PATH):
+    """
+    Use the saved tuning if it was made on this machine. Otherwise everything stays on Pillow
+    and the tuning runs the first time an op could go to OpenCV (see start_backend_tuning),
+    so neither OpenCV nor the benchmark hold up startup.
+    """
+    global _backend_choices, _backend_tuning_due
+    fingerprint = backend_fingerprint()
+    if fingerprint["opencv"] is None:
+        return  # no OpenCV, everything stays on Pillow
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+    if saved and saved.get("fingerprint") == fingerprint:
+        _backend_choices = {op: tuple(tuple(c) for c in entries) for op, entries in saved["choices"].items()}
+        return
+    _backend_tuning_due = True
+
+
+def start_backend_tuning(path=BACKEND_TUNING_PATH):
+    # Measures the backends in the background, ops keep using the current choice until it is done
+    global _backend_tuning_due
+    with _backend_tuning_lock:
+        if not _backend_tuning_due:
+            return
+        _backend_tuning_due = False
+
+    def tune():
+        try:
+            autotune_backends(path)
+        except ImportError:
+            pass  # OpenCV is installed but does not load, everything stays on Pillow
+
+    threading.Thread(target=tune, daemon=True).start()
+
+
+#-----------------------------
+# FILTERS
+#-----------------------------
+
+FILTER_NAMES = ("grayscale", "sepia", "invert", "blur")
+FILTER_LABELS = {"grayscale": "Gray", "sepia": "Sepia", "invert": "Invert", "blur": "Blur"}
+BLUR_RADIUS = 10
+GALLERY_PROXY_SIZE = 64
+GALLERY_WORKERS = 4
+
+# Pillow rounds matrix conversions, the -0.5 offsets turn that back into the truncation
+# the per-pixel sepia loop used
+SEPIA_MATRIX = (
+    0.393, 0.769, 0.189, -0.5,
+    0.349, 0.686, 0.168, -0.5,
+    0.272, 0.534, 0.131, -0.5,
+)
+
+# Every on/off combination of the filters, fewest filters first
+FILTER_COMBINATIONS = sorted(
+    (dict(zip(FILTER_NAMES, flags)) for flags in itertools.product((False, True), repeat=len(FILTER_NAMES))),
+    key=lambda states: (sum(states.values()), [not states[name] for name in FILTER_NAMES])
+)
+
+
+def filter_combination_label(filter_states):
+    names = [FILTER_LABELS[name] for name in FILTER_NAMES if filter_states[name]]
+    return "+".join(names) or "None"
+
+
+def apply_filters(img, filter_states, scale=1.0):
+    """
+    Apply the toggled filters in their fixed order to a WORKING_MODE image. scale is the size
+    of img relative to the full render, so previews get a proportionally smaller blur.
+    """
+    if filter_states["grayscale"]:
+        img = run_op("grayscale", img)
+
+    if filter_states["sepia"]:
+        img = run_op("sepia", img)
+
+    if filter_states["invert"]:
+        img = run_op("invert", img)
+
+    if filter_states["blur"]:
+        img = run_op("blur", img, BLUR_RADIUS * scale)
+
+    return img
+
+
+def filter_padding(filter_states):
+    # How far the filters spread a change to one pixel, in pixels
+    return int(BLUR_RADIUS * 3) if filter_states["blur"] else 0
+
+
+def render_filter_preview(proxy, filter_states, scale, brightness, contrast):
+    img = apply_filters(proxy, filter_states, scale)
+    img, _ = apply_tone(img, brightness, contrast)
+    return img
+
+
+#-----------------------------
+# LIVE LOOK
+#-----------------------------
+
+LIVE_LOOK_BLUR_DOWNSCALE = 4  # a blur this strong loses nothing when computed at a quarter of the size
+
+# SEPIA_MATRIX rows reordered for OpenCV's BGR channel order
+SEPIA_MATRIX_BGR = (
+    (0.131, 0.534, 0.272),
+    (0.168, 0.686, 0.349),
+    (0.189, 0.769, 0.393),
+)
+
+
+def make_live_look(filter_states, brightness, contrast):
+    """
+    Returns a function that applies the filter and tone state to a BGR webcam frame,
+    using whole-array OpenCV operations so no frame goes through PIL.
+    """
+    cv2 = load_cv2()
+    import numpy as np
+
+    filter_states = dict(filter_states)
+    sepia = np.array(SEPIA_MATRIX_BGR, dtype=np.float32)
+    bright = np.array(brightness_lut(brightness), dtype=np.uint8)
+    down = LIVE_LOOK_BLUR_DOWNSCALE
+
+    def look(frame):
+        if filter_states["grayscale"]:
+            frame = cv2.cvtColor(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+        if filter_states["sepia"]:
+            frame = cv2.transform(frame, sepia)
+        if filter_states["invert"]:
+            frame = cv2.bitwise_not(frame)
+        if filter_states["blur"]:
+            height, width = frame.shape[:2]
+            small = cv2.resize(frame, (width // down, height // down), interpolation=cv2.INTER_AREA)
+            small = cv2.GaussianBlur(small, (0, 0), BLUR_RADIUS / down, borderType=cv2.BORDER_REPLICATE)
+            frame = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+        if brightness != 1.0 or contrast != 1.0:
+            lut = bright
+            if contrast != 1.0:
+                # the contrast pivot is the frame's mean luminance, a tiny copy measures it well enough
+                thumb = cv2.LUT(cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA), bright)
+                mean = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY).mean()
+                lut = np.array(contrast_lut(contrast, int(mean + 0.5)), dtype=np.uint8)[bright]
+            frame = cv2.LUT(frame, lut)
+        return frame
+
+    return look
+
+
+def measure_live_look_fps(source, filter_states, brightness=1.0, contrast=1.0, max_frames=300):
+    """
+    Throughput of the live look on frames from source, a video file standing in for
+    the camera. Decoding is excluded, only the look itself is timed.
+    """
+    cv2 = load_cv2()
+    cap = cv2.VideoCapture(source)
+    look = make_live_look(filter_states, brightness, contrast)
+    frames = 0
+    elapsed = 0.0
+    size = None
+    while frames < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+        look(frame)
+        elapsed += time.perf_counter() - start
+        frames += 1
+        size = (frame.shape[1], frame.shape[0])
+    cap.release()
+    return {"frames": frames, "size": size, "fps": frames / elapsed if elapsed else 0.0}
+
+
+#-----------------------------
+# BURST CAPTURE
+#-----------------------------
+
+BURST_FRAMES = 10
+BURST_WORKERS = 2
+BURST_SCORE_WIDTH = 320  # sharpness is scored on a copy this wide
+
+
+class BurstBuffer:
+    """
+    The last few camera frames in a preallocated ring. Each frame is decoded straight
+    into its slot and scored for sharpness (variance of the Laplacian of a small gray
+    copy) on worker threads while the camera keeps running.
+    """
+
+    def __init__(self, shape, frames=BURST_FRAMES, workers=BURST_WORKERS):
+        import numpy as np
+        self.size = frames
+        height, width = shape[:2]
+        self.score_size = (BURST_SCORE_WIDTH, max(1, height * BURST_SCORE_WIDTH // width))
+        self.frames = np.empty((frames,) + tuple(shape), dtype=np.uint8)
+        self.gray = np.empty((height, width), dtype=np.uint8)
+        self.proxies = np.empty((frames, self.score_size[1], self.score_size[0]), dtype=np.uint8)
+        self.scores = np.full(frames, -1.0)
+        self.sequence = np.zeros(frames, dtype=np.int64)  # which frame each slot holds
+        self.count = 0
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = [None] * frames  # latest scoring job per slot
+
+    def read(self, cap):
+        # Returns the new frame, a view into the ring rather than a fresh array
+        cv2 = load_cv2()
+        slot = self.count % self.size
+        ret, _ = cap.read(self.frames[slot])
+        if not ret:
+            return None
+        self.count += 1
+        self.sequence[slot] = self.count
+        self.scores[slot] = -1.0
+        cv2.cvtColor(self.frames[slot], cv2.COLOR_BGR2GRAY, dst=self.gray)
+        cv2.resize(self.gray, self.score_size, dst=self.proxies[slot], interpolation=cv2.INTER_AREA)
+        self.futures[slot] = self.pool.submit(self.score, slot, self.count)
+        return self.frames[slot]
+
+    def score(self, slot, sequence):
+        cv2 = load_cv2()
+        sharpness = cv2.Laplacian(self.proxies[slot], cv2.CV_64F).var()
+        # the slot may have been overwritten by a newer frame while this ran
+        if self.sequence[slot] == sequence:
+            self.scores[slot] = sharpness
+
+    def wait_for_scores(self):
+        wait([future for future in self.futures if future is not None])
+
+    def sharpest(self):
+        self.wait_for_scores()
+        filled = min(self.count, self.size)
+        if not filled:
+            return None
+        best = int(self.scores[:filled].argmax())
+        return self.frames[best].copy()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def measure_burst_fps(source, max_frames=300):
+    """Frames per second the burst buffer can take in, scoring included, from a video file."""
+    cv2 = load_cv2()
+    cap = cv2.VideoCapture(source)
+    ret, frame = cap.read()
+    if not ret:
+        return {"frames": 0, "fps": 0.0}
+    burst = BurstBuffer(frame.shape)
+    start = time.perf_counter()
+    while burst.count < max_frames and burst.read(cap) is not None:
+        pass
+    burst.wait_for_scores()
+    elapsed = time.perf_counter() - start
+    cap.release()
+    burst.close()
+    return {"frames": burst.count, "fps": burst.count / elapsed if elapsed else 0.0}
+
+
+#-----------------------------
+# OVERLAYS
+#-----------------------------
+
+# Points closer than this fraction of the brush width to the last kept point are dropped
+# while drawing (0 keeps every mouse event)
+STROKE_DECIMATION = 0.25
+SHARP_JOINT_COS2 = 0.9 ** 2  # squared cosine of a ~25 degree turn
+
+
+def new_stroke(x, y, color, width):
+    # A stroke is one flat float array of x, y pairs sharing a single style
+    return {
+        "type": "stroke_group",
+        "color": color,
+        "width": width,
+        "points": array("f", (x, y)),
+    }
+
+
+def extend_stroke(stroke, x, y, decimation=STROKE_DECIMATION):
+    points = stroke["points"]
+    min_distance = stroke["width"] * decimation
+    if min_distance > 0:
+        dx = x - points[-2]
+        dy = y - points[-1]
+        if dx * dx + dy * dy < min_distance * min_distance:
+            return False
+    points.extend((x, y))
+    return True
+
+
+@lru_cache(maxsize=16)
+def load_overlay_font(size):
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except OSError:
+        return None  # Use default if arial.ttf is not found
+
+
+def stroke_round_points(points, width):
+    # The ends always need a round cap. Joints only need one where the path turns
+    # sharply, a gentle bend leaves no visible notch even on a wide brush.
+    rounded = [(points[0], points[1]), (points[-2], points[-1])]
+    if width <= 4:
+        return rounded
+    for i in range(2, len(points) - 2, 2):
+        ax, ay = points[i] - points[i - 2], points[i + 1] - points[i - 1]
+        bx, by = points[i + 2] - points[i], points[i + 3] - points[i + 1]
+        dot = ax * bx + ay * by
+        if dot < 0 or dot * dot < SHARP_JOINT_COS2 * (ax * ax + ay * ay) * (bx * bx + by * by):
+            rounded.append((points[i], points[i + 1]))
+    return rounded
+
+
+def draw_overlay_action(draw, action):
+    # Coordinates are rounded to whole pixels first: Pillow places fractional and negative ones
+    # differently, and a region render has to match the same part of a full render exactly
+    if action["type"] == "stroke_group":
+        points = [math.floor(v + 0.5) for v in action["points"]]
+        color, width = action["color"], action["width"]
+        # the whole stroke is a single polyline call, Pillow's own joint="curve" is a Python loop per point
+        if len(points) > 2:
+            draw.line(points, fill=color, width=width)
+        radius = (width - 1) / 2
+        if radius > 0:
+            for x, y in stroke_round_points(points, width):
+                draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+
+    elif action["type"] == "text":
+        font = load_overlay_font(max(1, round(action["font_size"] * 4)))
+        position = tuple(math.floor(v + 0.5) for v in action["position"])
+        draw.text(position, action["text"], font=font, fill=action["color"])
+
+
+def transform_action(action, scale=1.0, offset=(0, 0)):
+    # Copy of an overlay action for a scaled and/or shifted image
+    ox, oy = offset
+    moved = dict(action)
+    if action["type"] == "stroke_group":
+        points = action["points"]
+        # double precision, a float32 loses the fraction that decides the rounding when drawn
+        moved["points"] = array("d", (v * scale - (ox if i % 2 == 0 else oy) for i, v in enumerate(points)))
+        moved["width"] = max(1, round(action["width"] * scale))
+    elif action["type"] == "text":
+        x, y = action["position"]
+        moved["position"] = (x * scale - ox, y * scale - oy)
+        moved["font_size"] = action["font_size"] * scale
+    return moved
+
+
+#-----------------------------
+# LOCAL ADJUSTMENTS
+#-----------------------------
+
+MASK_TILE = 128  # side of a mask tile, only tiles that were painted on exist
+LOCAL_CONTRAST_PIVOT = 128  # local contrast turns around a fixed gray, so any region renders the same
+LOCAL_BRUSH_SCALE = 4  # the mask brush is this many times the drawing brush, in screen pixels
+LOCAL_FEATHER = 0.5  # softness of the mask brush edge, relative to its radius
+
+
+class SparseMask:
+    """
+    An 8-bit mask that stores only the MASK_TILE tiles something was painted on, an
+    untouched photo costs nothing. Tiles are never changed in place: painting returns a
+    new mask sharing every tile the stroke missed, so each history entry keeps its own.
+    """
+
+    def __init__(self, size, tiles=None):
+        self.size = size
+        self.tiles = tiles or {}  # (column, row) -> "L" image of MASK_TILE x MASK_TILE
+        self._digest = None
+
+    def __getstate__(self):
+        return {"size": self.size, "tiles": self.tiles}
+
+    def __setstate__(self, state):
+        self.size = state["size"]
+        self.tiles = state["tiles"]
+        self._digest = None
+
+    def tiles_in(self, box):
+        # Keys of every tile position overlapping box (left, upper, right, lower)
+        first_column, first_row = max(0, int(box[0]) // MASK_TILE), max(0, int(box[1]) // MASK_TILE)
+        last_column = (min(self.size[0], math.ceil(box[2])) - 1) // MASK_TILE
+        last_row = (min(self.size[1], math.ceil(box[3])) - 1) // MASK_TILE
+        return [(column, row) for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1)]
+
+    def painted(self, stroke, feather=LOCAL_FEATHER):
+        """
+        Copy with a brush stroke (see new_stroke) added, and the box it changed, None when
+        the stroke missed the mask. The edge fades out over feather times the brush radius.
+        """
+        points = stroke["points"]
+        blur = stroke["width"] / 2 * feather
+        pad = stroke["width"] / 2 + blur * 3 + 1
+        box = (max(0, int(min(points[0::2]) - pad)), max(0, int(min(points[1::2]) - pad)),
+               min(self.size[0], math.ceil(max(points[0::2]) + pad)),
+               min(self.size[1], math.ceil(max(points[1::2]) + pad)))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return self, None
+        stamp = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+        draw_overlay_action(ImageDraw.Draw(stamp), dict(transform_action(stroke, offset=box[:2]), color=255))
+        if blur > 0:
+            stamp = stamp.filter(ImageFilter.GaussianBlur(blur))
+
+        tiles = dict(self.tiles)
+        for column, row in self.tiles_in(box):
+            left, upper = column * MASK_TILE - box[0], row * MASK_TILE - box[1]
+            piece = stamp.crop((left, upper, left + MASK_TILE, upper + MASK_TILE))
+            tile = tiles.get((column, row))
+            tile = piece if tile is None else ImageChops.lighter(tile, piece)
+            if tile.getbbox() is not None:
+                tiles[(column, row)] = tile
+        return SparseMask(self.size, tiles), box
+
+    def crop(self, box):
+        # The mask over box (integer, may reach outside the mask), zero where nothing was painted
+        img = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+        for column, row in self.tiles_in(box):
+            tile = self.tiles.get((column, row))
+            if tile is not None:
+                img.paste(tile, (column * MASK_TILE - box[0], row * MASK_TILE - box[1]))
+        return img
+
+    def region(self, box, size):
+        # The mask over box (mask coordinates, possibly fractional) at size pixels
+        bounds = (math.floor(box[0]), math.floor(box[1]), math.ceil(box[2]), math.ceil(box[3]))
+        img = self.crop(bounds)
+        if bounds == tuple(box) and img.size == tuple(size):
+            return img
+        inner = (box[0] - bounds[0], box[1] - bounds[1], box[2] - bounds[0], box[3] - bounds[1])
+        return img.resize(size, Image.Resampling.BILINEAR, box=inner)
+
+    def bbox(self):
+        # Box of the painted tiles, None for an empty mask
+        if not self.tiles:
+            return None
+        columns = [column for column, _ in self.tiles]
+        rows = [row for _, row in self.tiles]
+        return (min(columns) * MASK_TILE, min(rows) * MASK_TILE,
+                min(self.size[0], (max(columns) + 1) * MASK_TILE), min(self.size[1], (max(rows) + 1) * MASK_TILE))
+
+    def digest(self):
+        # content hash for the render cache keys, computed once since the tiles never change
+        if self._digest is None:
+            digest = hashlib.sha1(f"{self.size[0]} {self.size[1]}|".encode("utf-8"))
+            for key in sorted(self.tiles):
+                digest.update(f"{key[0]},{key[1]}|".encode("utf-8"))
+                digest.update(self.tiles[key].tobytes())
+            self._digest = digest.hexdigest()
+        return self._digest
+
+
+def local_mask_nbytes(history):
+    # Bytes of the mask tiles held by the local entries of history, tiles shared between strokes once
+    tiles = {id(tile) for entry in history if entry["type"] == "local"
+             for tile in entry["data"]["mask"].tiles.values()}
+    return len(tiles) * MASK_TILE * MASK_TILE
+
+
+def apply_local(img, entry, scale=1.0, offset=(0, 0)):
+    """
+    Brightness and contrast of a local adjustment entry, blended in through its mask. img
+    covers offset onwards of the image the entry was painted on, shrunk by scale. Only the
+    part under painted tiles is adjusted, the rest is copied through.
+    """
+    data = entry["data"]
+    scale *= data.get("scale", 1.0)
+    left, upper = offset
+    box = (left / scale, upper / scale, (left + img.size[0]) / scale, (upper + img.size[1]) / scale)
+    mask = data["mask"].region(box, img.size)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return img
+    part = img.crop(bbox)
+    adjusted, _ = apply_tone(part, data["brightness"], data["contrast"], mean=LOCAL_CONTRAST_PIVOT)
+    img = img.copy()
+    img.paste(Image.composite(adjusted, part, mask.crop(bbox)), bbox[:2])
+    return img
+
+
+#-----------------------------
+# RENDER PIPELINE
+#-----------------------------
+
+GEOMETRY_TYPES = ("crop", "rotate", "flip", "resize")
+STAGE_TYPES = GEOMETRY_TYPES + ("overlay", "color", "local")  # entries that change pixels, in history order
+PROXY_SIZE = 512  # longest side of the per-document proxy used for whole-image estimates
+VIEWPORT_RENDER_FRACTION = 0.5  # render only the visible region when less than this much is on screen
+VIEWPORT_MARGIN = 0.25  # extra region rendered on each side, as a fraction of the view
+PAN_MARGIN = 0.25  # extra display buffer on each side, as a fraction of the canvas
+COMPARE_GAP = 8  # pixels between the two pictures of the side-by-side comparison
+
+
+def quarter_turns(angle):
+    return (angle // 90) % 4
+
+
+def geometry_size(size, entry):
+    # Image size after a geometric history entry
+    if entry["type"] == "resize":
+        scale = entry["data"]["scale"]
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+    if entry["type"] == "crop":
+        left, upper, right, lower = entry["data"]["box"]
+        return right - left, lower - upper
+    if entry["type"] == "rotate" and quarter_turns(entry["data"]["angle"]) % 2:
+        return size[1], size[0]
+    return size
+
+
+def plan_history(history):
+    """
+    The history with every resize folded into one resize at the front, so the ops after it
+    run on the smaller image. Crop boxes, overlays and masks are scaled by the resizes that came
+    after them. A local adjustment entry directly followed by another stroke on the same layer
+    is dropped, the later entry's mask already holds it. Planning a planned history returns it
+    unchanged.
+    """
+    remaining = 1.0  # product of the resizes still to come
+    scales = []
+    for entry in reversed(history):
+        scales.append(remaining)
+        if entry["type"] == "resize":
+            remaining *= entry["data"]["scale"]
+    scales.reverse()
+
+    superseded = set()
+    previous = None  # index of the last entry that changes pixels
+    for i, entry in enumerate(history):
+        if entry["type"] not in STAGE_TYPES:
+            continue
+        if (entry["type"] == "local" and previous is not None and history[previous]["type"] == "local"
+                and history[previous]["data"]["layer"] == entry["data"]["layer"]):
+            superseded.add(previous)
+        previous = i
+
+    planned = [{"type": "resize", "data": {"scale": remaining}}] if remaining != 1.0 else []
+    for i, (entry, scale) in enumerate(zip(history, scales)):
+        if entry["type"] == "resize" or i in superseded:
+            continue
+        if scale != 1.0 and entry["type"] == "crop":
+            left, upper, right, lower = (round(v * scale) for v in entry["data"]["box"])
+            entry = {"type": "crop", "data": {"box": (left, upper, max(right, left + 1), max(lower, upper + 1))}}
+        elif scale != 1.0 and entry["type"] == "overlay":
+            entry = {"type": "overlay", "data": {"action": transform_action(entry["data"]["action"], scale)}}
+        elif scale != 1.0 and entry["type"] == "local":
+            entry = {"type": "local", "data": dict(entry["data"], scale=entry["data"].get("scale", 1.0) * scale)}
+        planned.append(entry)
+    return planned
+
+
+def history_size(size, history):
+    for entry in plan_history(history):
+        if entry["type"] in GEOMETRY_TYPES:
+            size = geometry_size(size, entry)
+    return size
+
+
+def map_rect_forward(rect, size, entry):
+    # Where rect (left, upper, right, lower) ends up after the entry, size is the image size before it
+    left, upper, right, lower = rect
+    width, height = size
+    if entry["type"] == "resize":
+        new_width, new_height = geometry_size(size, entry)
+        scale_x, scale_y = new_width / width, new_height / height
+        return left * scale_x, upper * scale_y, right * scale_x, lower * scale_y
+    if entry["type"] == "crop":
+        box_left, box_upper = entry["data"]["box"][:2]
+        return left - box_left, upper - box_upper, right - box_left, lower - box_upper
+    if entry["type"] == "rotate":
+        # counter-clockwise quarter turns, as Image.rotate(90, expand=True)
+        for _ in range(quarter_turns(entry["data"]["angle"])):
+            left, upper, right, lower = upper, width - right, lower, width - left
+            width, height = height, width
+        return left, upper, right, lower
+    if entry["type"] == "flip":
+        if entry["data"]["direction"] == "horizontal":
+            return width - right, upper, width - left, lower
+        return left, height - lower, right, height - upper
+    return rect
+
+
+def map_rect_backward(rect, size, entry):
+    # Inverse of map_rect_forward, size is still the image size before the entry
+    left, upper, right, lower = rect
+    if entry["type"] == "resize":
+        new_width, new_height = geometry_size(size, entry)
+        scale_x, scale_y = size[0] / new_width, size[1] / new_height
+        return left * scale_x, upper * scale_y, right * scale_x, lower * scale_y
+    if entry["type"] == "crop":
+        box_left, box_upper = entry["data"]["box"][:2]
+        return left + box_left, upper + box_upper, right + box_left, lower + box_upper
+    if entry["type"] == "rotate":
+        sizes = [size]
+        for _ in range(quarter_turns(entry["data"]["angle"])):
+            sizes.append((sizes[-1][1], sizes[-1][0]))
+        for width, height in reversed(sizes[:-1]):
+            left, upper, right, lower = width - lower, left, width - upper, right
+        return left, upper, right, lower
+    if entry["type"] == "flip":
+        return map_rect_forward(rect, size, entry)
+    return rect
+
+
+def apply_geometry(img, entry):
+    if entry["type"] == "resize":
+        return run_op("resize", img, geometry_size(img.size, entry))
+    if entry["type"] == "crop":
+        return img.crop(entry["data"]["box"])
+    if entry["type"] == "rotate":
+        return run_op("rotate", img, entry["data"]["angle"])
+    return run_op("flip", img, entry["data"]["direction"])
+
+
+def apply_color(img, entry):
+    # numpy comes with colortools, only imported once a color is replaced
+    from colortools import replace_color
+    data = entry["data"]
+    return replace_color(img, data["source"], data["target"], data["tolerance"], data["space"], data["softness"])
+
+
+def render_stage(original, history, scale=1.0):
+    """
+    Geometric edits, overlays, color replacements and local adjustments in history order,
+    the part of the render that has to run in sequence. scale is the size of original relative to the real source, for proxies.
+    """
+    img = original
+    history = plan_history(history)
+    if history and history[0]["type"] == "resize" and scale != 1.0:
+        # a proxy may already be smaller than the resize asks for, then it only rescales the rest
+        resize_scale = history[0]["data"]["scale"]
+        history = history[1:]
+        if scale > resize_scale:
+            size = (round(img.size[0] / scale * resize_scale), round(img.size[1] / scale * resize_scale))
+            img = run_op("resize", img, size)
+            scale = 1.0
+        else:
+            scale /= resize_scale
+    for entry in history:
+        if entry["type"] == "crop" and scale != 1.0:
+            box = tuple(round(v * scale) for v in entry["data"]["box"])
+            img = img.crop(box)
+        elif entry["type"] in GEOMETRY_TYPES:
+            img = apply_geometry(img, entry)
+        elif entry["type"] == "overlay":
+            if img is original:
+                img = img.copy()  # overlays draw in place, never on the caller's image
+            action = entry["data"]["action"]
+            if scale != 1.0:
+                action = transform_action(action, scale)
+            draw_overlay_action(ImageDraw.Draw(img), action)
+        elif entry["type"] == "color":
+            img = apply_color(img, entry)
+        elif entry["type"] == "local":
+            img = apply_local(img, entry, scale)
+    return img
+
+
+def render_proxy(proxy, scale, history, filter_states, brightness, contrast):
+    """
+    Whole-image render of a small proxy. Returns the render before filters and tone, the
+    finished proxy, and its statistics, whose contrast_mean stands in for the full image's.
+    """
+    prefilter = render_stage(proxy, history, scale)
+    planned = plan_history(history)
+    if planned and planned[0]["type"] == "resize":
+        scale = min(1.0, scale / planned[0]["data"]["scale"])  # blur is relative to the resized render
+    img = apply_filters(prefilter, filter_states, scale)
+    img, stats = apply_tone(img, brightness, contrast)
+    if stats is None:
+        stats = image_statistics(img)
+    return prefilter, img, stats
+
+
+def render_region(original, history, region, filter_states, brightness, contrast, contrast_mean=None):
+    """
+    Render only region (left, upper, right, lower in final render coordinates). The region is
+    padded for the blur, mapped back through the geometric edits to the source pixels it comes
+    from, and only those pixels go through the pipeline.
+    """
+    history = plan_history(history)
+    if history and history[0]["type"] == "resize":
+        # callers normally pass the resized source instead, see PhotoEditor.render_source
+        original = apply_geometry(original, history[0])
+        history = history[1:]
+    pad = filter_padding(filter_states)
+    sizes = [original.size]
+    for entry in history:
+        if entry["type"] in GEOMETRY_TYPES:
+            sizes.append(geometry_size(sizes[-1], entry))
+    width, height = sizes[-1]
+    padded = (max(0, region[0] - pad), max(0, region[1] - pad),
+              min(width, region[2] + pad), min(height, region[3] + pad))
+
+    geometry = [entry for entry in history if entry["type"] in GEOMETRY_TYPES]
+    rect = padded
+    for entry, size in zip(reversed(geometry), reversed(sizes[:-1])):
+        rect = map_rect_backward(rect, size, entry)
+
+    img = original.crop(rect)
+    size = original.size
+    for entry in history:
+        if entry["type"] in GEOMETRY_TYPES:
+            rect = map_rect_forward(rect, size, entry)
+            size = geometry_size(size, entry)
+            if entry["type"] != "crop":  # the region already lies inside every crop box
+                img = apply_geometry(img, entry)
+        elif entry["type"] == "overlay":
+            action = transform_action(entry["data"]["action"], offset=rect[:2])
+            draw_overlay_action(ImageDraw.Draw(img), action)
+        elif entry["type"] == "color":
+            img = apply_color(img, entry)
+        elif entry["type"] == "local":
+            img = apply_local(img, entry, offset=rect[:2])
+
+    img = apply_filters(img, filter_states)
+    img, _ = apply_tone(img, brightness, contrast, mean=contrast_mean)
+    return img.crop((region[0] - rect[0], region[1] - rect[1], region[2] - rect[0], region[3] - rect[1]))
+
+
+def check_region_render(size=(1600, 1200), regions=20, seed=1):
+    """
+    Largest pixel difference between render_region and the same part of a full render, for a
+    history with a resize in front of strokes, text, a turn and a crop. 0 when they agree.
+    """
+    import random
+    rng = random.Random(seed)
+    original = benchmark_image(size)
+
+    def stroke(points, width):
+        action = new_stroke(rng.uniform(0, size[0]), rng.uniform(0, size[1]), "#ff0000", width)
+        for _ in range(points):
+            extend_stroke(action, rng.uniform(0, size[0]), rng.uniform(0, size[1]), decimation=0)
+        return action
+
+    history = [
+        {"type": "overlay", "data": {"action": stroke(6, 9)}},
+        {"type": "resize", "data": {"scale": 0.37}},
+        {"type": "overlay", "data": {"action": stroke(10, 3)}},
+        {"type": "overlay", "data": {"action": {"type": "text", "text": "Region", "position": (123.37, 88.61),
+                                                "color": "#00ff00", "font_size": 6}}},
+        {"type": "rotate", "data": {"angle": 90}},
+        {"type": "crop", "data": {"box": (20, 30, 400, 560)}},
+        {"type": "overlay", "data": {"action": stroke(8, 5)}},
+    ]
+    filter_states = dict(dict.fromkeys(FILTER_NAMES, False), sepia=True, blur=True)
+    full = apply_filters(render_stage(original, history), filter_states)
+    full, _ = apply_tone(full, 1.1, 1.0)
+    width, height = full.size
+    worst = 0
+    for _ in range(regions):
+        left, upper = rng.randrange(width - 10), rng.randrange(height - 10)
+        box = (left, upper, rng.randrange(left + 10, width + 1), rng.randrange(upper + 10, height + 1))
+        region = render_region(original, history, box, filter_states, 1.1, 1.0)
+        extrema = ImageChops.difference(region, full.crop(box)).getextrema()
+        worst = max(worst, max(high for _, high in extrema))
+    return worst
+
+
+#-----------------------------
+# RENDER CACHE
+#-----------------------------
+
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, "renders")
+RENDER_CACHE_LIMIT = 2 * 1024 * 1024 * 1024  # bytes on disk before the least recently used renders go
+RENDER_CACHE_MIN_MS = 50  # renders quicker than this are not worth a disk write
+
+
+def source_digest(img):
+    # Content address of the pixels themselves, the same photo hashes the same from any path
+    digest = hashlib.sha1(f"{img.mode} {img.size[0]} {img.size[1]}|".encode("utf-8"))
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def history_json(value):
+    # stroke points are float arrays and masks are named by their content, everything else is plain JSON
+    if isinstance(value, SparseMask):
+        return value.digest()
+    return list(value)
+
+
+def history_entry_bytes(entry):
+    return json.dumps(entry, sort_keys=True, default=history_json).encode("utf-8")
+
+
+def stage_cache_keys(digest, history):
+    """
+    Key of every prefix of the planned STAGE_TYPES entries (see plan_history): keys[i]
+    names the render after the first i of them. Filter and tone entries only set state, so they
+    don't advance the chain.
+    """
+    keys = [digest]
+    for entry in plan_history(history):
+        if entry["type"] in STAGE_TYPES:
+            keys.append(hashlib.sha1(keys[-1].encode("utf-8") + history_entry_bytes(entry)).hexdigest())
+    return keys
+
+
+def final_cache_key(stage_key, filter_states, brightness, contrast):
+    look = json.dumps([filter_states, brightness, contrast], sort_keys=True)
+    return hashlib.sha1(f"{stage_key}|{look}".encode("utf-8")).hexdigest()
+
+
+def write_raw_image(path, img):
+    # A one line header and the pixel buffer, reading it back is a single read and no decoding
+    atomic_write(path, [f"{img.mode} {img.size[0]} {img.size[1]}\n".encode("ascii"), img.tobytes()])
+
+
+def read_raw_image(path):
+    with open(path, "rb") as f:
+        mode, width, height = f.readline().decode("ascii").split()
+        return Image.frombytes(mode, (int(width), int(height)), f.read())
+
+
+class RenderCache:
+    """
+    Renders on disk, addressed by what produced them (see stage_cache_keys), so reopening a
+    photo with the same edits reads the result instead of computing it again. Files are
+    touched when read, and once the directory outgrows the limit the least recently used go.
+    """
+
+    def __init__(self, cache_dir=RENDER_CACHE_DIR, limit=RENDER_CACHE_LIMIT):
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self.lock = threading.Lock()  # one eviction pass at a time
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".raw")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            img = read_raw_image(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None  # missing, evicted meanwhile, or a truncated file
+        return img
+
+    def longest_prefix(self, keys):
+        # (index, image) of the longest cached prefix, (0, None) when there is none
+        for i in range(len(keys) - 1, 0, -1):
+            if os.path.exists(self.path(keys[i])):
+                img = self.get(keys[i])
+                if img is not None:
+                    return i, img
+        return 0, None
+
+    def prefix_length(self, keys):
+        # like longest_prefix without reading the image, for a reader in another process
+        for i in range(len(keys) - 1, 0, -1):
+            if os.path.exists(self.path(keys[i])):
+                return i
+        return 0
+
+    def put(self, key, img):
+        write_raw_image(self.path(key), img)
+        self.enforce_limit()
+
+    def enforce_limit(self):
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".raw"):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.limit:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+
+#-----------------------------
+# RENDER WORKERS
+#-----------------------------
+
+RENDER_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+WORKER_RENDER_MIN_PIXELS = 4_000_000  # smaller sources render before a worker would even have the job
+WORKER_POLL_MS = 30
+SHAREABLE_MODES = ("RGB", "RGBA", "L")  # modes that survive as raw bytes, no palette to lose
+
+
+class SharedImage:
+    """
+    An image's pixels in a named shared memory block. Workers attach to it by name
+    (see attach_image), so the pixels never get pickled through a pipe on the way to
+    another process.
+    """
+
+    def __init__(self, img):
+        from multiprocessing import shared_memory
+        data = img.tobytes()
+        self.image = img
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        self.shm.buf[:len(data)] = data
+        self.handle = (self.shm.name, img.mode, img.size)
+        self.jobs = 0  # worker renders still reading it
+        self.retired = False  # replaced, freed once the last of those jobs is done
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_image(handle):
+    # The image in a shared block. "L" and "RGBA" are mapped onto the block as they are, "RGB"
+    # has no mapped layout in Pillow and gets decoded into a copy. Close the block only once
+    # a mapped image is gone
+    from multiprocessing import shared_memory
+    name, mode, size = handle
+    shm = shared_memory.SharedMemory(name=name)
+    return Image.frombuffer(mode, size, shm.buf, "raw", mode, 0, 1), shm
+
+
+def share_result(img):
+    # A new block for a worker's result, the caller that reads it unlinks it
+    from multiprocessing import shared_memory
+    data = img.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    shm.buf[:len(data)] = data
+    shm.close()
+    return shm.name, img.mode, img.size
+
+
+def take_result(handle):
+    # A worker's result out of its block, then the block is freed
+    img, shm = attach_image(handle)
+    if img.readonly:
+        img = img.copy()  # mapped onto the block, copied once before it goes
+    shm.close()
+    shm.unlink()
+    return img
+
+
+def worker_render(handle, history, filter_states, brightness, contrast, backend_choices, prefix=None):
+    """
+    Runs in a render worker: replays history on the shared source (see PhotoEditor.render_source
+    for what history starts from) and returns handles to the render before filters and tone,
+    the finished render, and its statistics. prefix is (path, rest) when the render cache holds
+    part of the history already, then only rest is replayed on the cached file.
+    """
+    # the parent's tuning comes with every job, it may have finished after the workers started
+    global _backend_choices
+    _backend_choices = backend_choices
+    source, shm = attach_image(handle)
+    if prefix is not None:
+        try:
+            source, history = read_raw_image(prefix[0]), prefix[1]
+        except (OSError, ValueError):
+            pass  # evicted meanwhile, the whole history it is
+    prefilter = render_stage(source, history)
+    img = apply_filters(prefilter, filter_states)
+    img, stats = apply_tone(img, brightness, contrast)
+    prefilter_handle = share_result(prefilter)
+    image_handle = prefilter_handle if img is prefilter else share_result(img)
+    # every image that may still point into the source block has to go before it can close
+    del source, prefilter, img
+    shm.close()
+    return prefilter_handle, image_handle, stats
+
+
+def start_render_workers():
+    # spawn, not fork: a forked child would inherit the Tk connection and the GUI's threads
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+#-----------------------------
+# FACE DETECTION
+#-----------------------------
+
+FACE_PROXY_SIZE = 800  # longest side scanned for candidates
+FACE_REFINE_PADDING = 0.25  # context around a candidate when it is checked at full resolution
+FACE_CROP_PADDING = 0.5  # room left around the faces by auto-crop, relative to their extent
+FACE_CACHE_DIR = os.path.join(CACHE_DIR, "faces")
+
+_face_cascade_lock = threading.Lock()
+
+
+def new_face_cascade():
+    cv2 = load_cv2()
+    return cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+
+@lru_cache(maxsize=1)
+def still_face_cascade():
+    # separate from the webcam's, detectMultiScale must not run on one cascade from two threads
+    return new_face_cascade()
+
+
+def detect_faces(img):
+    """
+    Face boxes (left, upper, right, lower) in img's coordinates. The whole picture is only
+    scanned as a small proxy; each candidate is then checked again at full resolution, where
+    the search is limited to sizes close to the candidate's.
+    """
+    import numpy as np
+    scale = min(1.0, FACE_PROXY_SIZE / max(img.size))
+    proxy_size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+    proxy = img.resize(proxy_size, Image.Resampling.BILINEAR, reducing_gap=2.0).convert("L")
+
+    with _face_cascade_lock:
+        cascade = still_face_cascade()
+        candidates = cascade.detectMultiScale(np.asarray(proxy), scaleFactor=1.1, minNeighbors=5)
+        faces = []
+        for x, y, w, h in candidates:
+            left, upper, right, lower = x / scale, y / scale, (x + w) / scale, (y + h) / scale
+            side = right - left
+            pad = side * FACE_REFINE_PADDING
+            region = (max(0, int(left - pad)), max(0, int(upper - pad)),
+                      min(img.size[0], int(right + pad) + 1), min(img.size[1], int(lower + pad) + 1))
+            crop = np.asarray(img.crop(region).convert("L"))
+            found = cascade.detectMultiScale(crop, scaleFactor=1.05, minNeighbors=3,
+                                             minSize=(int(side * 0.7),) * 2, maxSize=(int(side * 1.4) + 1,) * 2)
+            if len(found):
+                # the largest hit is the candidate itself, smaller ones are eyes and noise
+                fx, fy, fw, fh = max(found, key=lambda f: f[2] * f[3])
+                faces.append((region[0] + int(fx), region[1] + int(fy),
+                              region[0] + int(fx + fw), region[1] + int(fy + fh)))
+            else:
+                faces.append((int(left), int(upper), int(right), int(lower)))
+    return faces
+
+
+def detect_faces_cached(img, path=None, cache_dir=FACE_CACHE_DIR):
+    # Results for files on disk are kept next to the thumbnails, keyed the same way
+    cache_path = os.path.join(cache_dir, thumbnail_cache_key(path) + ".json") if path else None
+    if cache_path:
+        try:
+            with open(cache_path) as f:
+                return [tuple(box) for box in json.load(f)]
+        except (OSError, ValueError):
+            pass
+
+    faces = detect_faces(img)
+    if cache_path:
+        atomic_write(cache_path, json.dumps(faces))
+    return faces
+
+
+def map_faces(faces, size, history):
+    # Face boxes in original coordinates, carried through the geometric edits to the render
+    boxes = list(faces)
+    for entry in plan_history(history):
+        if entry["type"] not in GEOMETRY_TYPES:
+            continue
+        boxes = [map_rect_forward(box, size, entry) for box in boxes]
+        size = geometry_size(size, entry)
+        # partly cropped faces are clipped, faces cropped away are dropped
+        boxes = [(max(0, l), max(0, u), min(size[0], r), min(size[1], b)) for l, u, r, b in boxes]
+        boxes = [box for box in boxes if box[2] > box[0] and box[3] > box[1]]
+    return boxes
+
+
+def face_crop_box(faces, size, padding=FACE_CROP_PADDING):
+    # All faces plus some room around them, clipped to the image
+    left = min(box[0] for box in faces)
+    upper = min(box[1] for box in faces)
+    right = max(box[2] for box in faces)
+    lower = max(box[3] for box in faces)
+    pad_x = (right - left) * padding
+    pad_y = (lower - upper) * padding
+    return (max(0, int(left - pad_x)), max(0, int(upper - pad_y)),
+            min(size[0], round(right + pad_x)), min(size[1], round(lower + pad_y)))
+
+
+#-----------------------------
+# TONE & STATISTICS
+#-----------------------------
+
+HISTOGRAM_SAMPLE_SIZE = 256  # longest side of the sample used when no render statistics are available
+
+
+def _float32(value):
+    # Pillow blends in single precision, round the same way so the lookup tables match ImageEnhance
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+def histogram_mean(histogram):
+    count = sum(histogram)
+    if not count:
+        return 0.0
+    return sum(value * n for value, n in enumerate(histogram)) / count
+
+
+def image_statistics(img):
+    """Per-channel histograms and mean luminance of an image."""
+    rgb = img if img.mode == "RGB" else img.convert("RGB")
+    histogram = rgb.histogram()
+    luminance = rgb.convert("L").histogram()
+    return {
+        "red": histogram[0:256],
+        "green": histogram[256:512],
+        "blue": histogram[512:768],
+        "luminance": luminance,
+        "mean": histogram_mean(luminance),
+        "pixels": sum(luminance),
+    }
+
+
+def remap_statistics(stats, lut):
+    # A per-value lookup table moves whole histogram bins, so the statistics of the
+    # adjusted image follow from the old ones without touching any pixels
+    remapped = {"pixels": stats["pixels"]}
+    for name in ("red", "green", "blue", "luminance"):
+        histogram = [0] * 256
+        for value, count in enumerate(stats[name]):
+            histogram[lut[value]] += count
+        remapped[name] = histogram
+    remapped["mean"] = histogram_mean(remapped["luminance"])
+    return remapped
+
+
+def sample_for_statistics(img, max_size=HISTOGRAM_SAMPLE_SIZE):
+    # Nearest-neighbour picks a regular subset of pixels, which is all a histogram needs
+    width, height = img.size
+    scale = max_size / max(width, height)
+    if scale >= 1:
+        return img
+    return img.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.Resampling.NEAREST)
+
+
+def brightness_lut(factor):
+    factor = _float32(factor)
+    return [min(255, int(_float32(factor * value))) for value in range(256)]
+
+
+def contrast_lut(factor, mean):
+    factor = _float32(factor)
+    return [max(0, min(255, int(_float32(mean + _float32(factor * (value - mean)))))) for value in range(256)]
+
+
+def apply_tone(img, brightness, contrast, mean=None):
+    """
+    Brightness and contrast as lookup tables, pixel-identical to ImageEnhance.
+    Returns the adjusted image and, when contrast had to measure it, its statistics.
+    mean replaces the measured luminance when img is only part of the picture.
+    """
+    if img.mode not in ("L", "RGB", "RGBA"):
+        img = ImageEnhance.Brightness(img).enhance(brightness)
+        return ImageEnhance.Contrast(img).enhance(contrast), None
+
+    bands = len(img.getbands())
+    identity = list(range(256))
+
+    def channel_luts(lut):
+        # alpha is left untouched, as ImageEnhance does
+        return lut * 3 + identity if bands == 4 else lut * bands
+
+    if brightness != 1.0:
+        img = img.point(channel_luts(brightness_lut(brightness)))
+    if contrast == 1.0:
+        return img, None
+    if mean is not None:
+        return img.point(channel_luts(contrast_lut(contrast, int(mean + 0.5)))), None
+
+    stats = image_statistics(img)
+    lut = contrast_lut(contrast, int(stats["mean"] + 0.5))
+    remapped = remap_statistics(stats, lut)
+    remapped["contrast_mean"] = stats["mean"]
+    return img.point(channel_luts(lut)), remapped
+
+
+#-----------------------------
+# EXPORT
+#-----------------------------
+
+# (file suffix, longest edge in pixels): five web sizes and a thumbnail
+EXPORT_PRESET = (
+    ("2048", 2048),
+    ("1600", 1600),
+    ("1280", 1280),
+    ("1024", 1024),
+    ("800", 800),
+    ("thumb", 256),
+)
+EXPORT_WORKERS = 4
+EXPORT_QUALITY = 90
+
+
+def build_pyramid(img, smallest_edge):
+    # Each level halves the previous one with reduce(), a cheap box filter
+    levels = [img]
+    while max(levels[-1].size) // 2 >= smallest_edge:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def pyramid_source(levels, long_edge):
+    # the smallest level that is still at least as large as the target
+    for level in reversed(levels):
+        if max(level.size) >= long_edge:
+            return level
+    return levels[0]
+
+
+def decode_reduced(path, size):
+    """
+    Decode a JPEG straight at 1/2, 1/4 or 1/8 scale, whichever is the smallest still at least
+    size, and resize the rest of the way, in the working format. None for other formats.
+    """
+    with Image.open(path) as img:
+        if img.format != "JPEG":
+            return None
+        img.draft(img.mode, size)
+        img.load()
+        img, _ = to_working_format(img)
+        if img.size != size:
+            return run_op("resize", img, size)
+        return img
+
+
+def export_sizes(img, folder, stem, preset=EXPORT_PRESET, workers=EXPORT_WORKERS):
+    """
+    Write img at every size in preset from one pyramid. Each size is resampled from the
+    nearest larger level, so only the first level touches the full-resolution pixels,
+    and the sizes are resized and encoded in parallel (Pillow releases the GIL for both).
+    """
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    levels = build_pyramid(img, min(edge for _, edge in preset))
+
+    def export_one(entry):
+        suffix, edge = entry
+        scale = edge / max(img.size)
+        out = img
+        if scale < 1:
+            size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+            out = run_op("resize", pyramid_source(levels, edge), size)
+        path = os.path.join(folder, f"{stem}_{suffix}.jpg")
+        out.save(path, "JPEG", quality=EXPORT_QUALITY)
+        return path
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(export_one, preset))
+
+
+#-----------------------------
+# WORKING FORMAT
+#-----------------------------
+
+WORKING_MODE = "RGB"
+ALPHA_FORMATS = (".png", ".webp", ".tif", ".tiff")  # export formats that can store the alpha plane
+
+
+def to_working_format(img):
+    """
+    Split a decoded image into what every op works on: WORKING_MODE pixels, and the alpha as a
+    separate "L" plane when the file has any transparency (None otherwise). Done once at load,
+    so no op has to check or convert modes on each render.
+    """
+    if (img.mode == "P" and "transparency" in img.info) or img.mode in ("LA", "La", "PA", "RGBa"):
+        img = img.convert("RGBA")
+    alpha = None
+    if img.mode == "RGBA":
+        alpha = img.getchannel("A")
+        if alpha.getextrema() == (255, 255):
+            alpha = None  # fully opaque, nothing worth keeping
+    if img.mode in ("I;16", "I;16B", "I;16L"):
+        img = img.convert("I").point(lambda v: v / 256).convert("L")  # 16-bit grays, not clipped at 255
+    if img.mode != WORKING_MODE:
+        img = img.convert(WORKING_MODE)
+    return img, alpha
+
+
+def render_alpha(alpha, history):
+    # The alpha plane through the geometric edits, overlays paint it opaque; the rest leaves it alone
+    entries = []
+    for entry in plan_history(history):
+        if entry["type"] in GEOMETRY_TYPES:
+            entries.append(entry)
+        elif entry["type"] == "overlay":
+            entries.append({"type": "overlay", "data": {"action": dict(entry["data"]["action"], color=255)}})
+    return render_stage(alpha, entries)
+
+
+def export_image(img, alpha, history, path):
+    # The render as the file at path stores it, the only place the working format is converted back
+    if alpha is not None and os.path.splitext(path)[1].lower() in ALPHA_FORMATS:
+        img = img.copy()
+        img.putalpha(render_alpha(alpha, history))
+    return img
+
+
+#-----------------------------
+# DOCUMENTS
+#-----------------------------
+
+DOCUMENT_MEMORY_BUDGET = 1024 * 1024 * 1024  # bytes of decoded pixels kept in memory across open documents
+
+
+def image_nbytes(img):
+    if img is None:
+        return 0
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+class Document:
+    def __init__(self, name, original_image, path=None, alpha=None):
+        self.name = name
+        self.path = path
+        self.original_image = original_image  # always WORKING_MODE, see to_working_format
+        self.alpha = alpha  # the original's transparency, only applied again on export
+        self.render = None  # last full render, so switching back needs no replay
+        self.prefilter = None  # the render before filters and tone, source of the filter gallery
+        self.proxy = None  # small copy of the original for whole-image estimates, kept when spilled
+        self.faces = None  # face boxes in original coordinates once detected, see detect_faces
+        self.face_job = None
+        self.digest = None  # source_digest of the original, computed the first time it is needed
+        self.reduced = None  # (size, image): the original at the size of a leading resize
+        # to tell whether the file still holds these pixels when it is decoded again
+        self.path_stat = None
+        if path:
+            st = os.stat(path)
+            self.path_stat = (st.st_mtime_ns, st.st_size)
+        self.history_stack = []
+        self.history_redo_stack = []
+        self.spill_path = None  # set while the pixels live on disk instead of in memory
+
+    @property
+    def spilled(self):
+        return self.spill_path is not None
+
+    def memory_size(self):
+        size = image_nbytes(self.original_image) + image_nbytes(self.proxy)
+        if self.render is not self.original_image:  # the same image while no edit changes pixels
+            size += image_nbytes(self.render)
+        size += image_nbytes(self.alpha)
+        if self.reduced is not None:
+            size += image_nbytes(self.reduced[1])
+        if self.prefilter is not self.render:
+            size += image_nbytes(self.prefilter)
+        size += local_mask_nbytes(self.history_stack + self.history_redo_stack)
+        return size
+
+
+class DocumentCache:
+    """
+    Open documents in least-recently-used order. Once the decoded pixels exceed the
+    memory budget, the oldest documents are written to a temporary directory as raw
+    pixels (no encoding), which reads back in milliseconds when they are reopened.
+    """
+
+    def __init__(self, budget=DOCUMENT_MEMORY_BUDGET):
+        self.budget = budget
+        self.documents = OrderedDict()  # id(document) -> document, most recent last
+        self.spill_dir = None
+
+    def __iter__(self):
+        return iter(self.documents.values())
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc):
+        self.documents[id(doc)] = doc
+
+    def activate(self, doc):
+        # eviction is left to enforce_budget, so the caller can run it once the switch is on screen
+        if doc.spilled:
+            self.load(doc)
+        self.documents.move_to_end(id(doc))
+
+    def remove(self, doc):
+        self.documents.pop(id(doc), None)
+        if doc.spilled:
+            os.remove(doc.spill_path)
+            doc.spill_path = None
+
+    def most_recent(self):
+        return next(reversed(self.documents.values()), None)
+
+    def memory_size(self):
+        return sum(doc.memory_size() for doc in self.documents.values() if not doc.spilled)
+
+    def enforce_budget(self, keep=None):
+        for doc in list(self.documents.values()):
+            if self.memory_size() <= self.budget:
+                break
+            if doc is not keep and not doc.spilled:
+                self.spill(doc)
+
+    def spill(self, doc):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="photoeditor_documents_")
+            atexit.register(shutil.rmtree, self.spill_dir, True)
+        path = os.path.join(self.spill_dir, f"{id(doc)}.pickle")
+        # PIL images pickle as their raw pixel buffer, an image shared by two fields is written once
+        with open(path, "wb") as f:
+            pickle.dump({"original": doc.original_image, "render": doc.render, "prefilter": doc.prefilter,
+                         "alpha": doc.alpha}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        doc.original_image = None
+        doc.alpha = None
+        doc.render = None
+        doc.prefilter = None
+        doc.reduced = None  # cheap to make again from the original
+        doc.spill_path = path
+
+    def load(self, doc):
+        with open(doc.spill_path, "rb") as f:
+            data = pickle.load(f)
+        os.remove(doc.spill_path)
+        doc.original_image = data["original"]
+        doc.render = data["render"]
+        doc.prefilter = data["prefilter"]
+        doc.alpha = data["alpha"]
+        doc.spill_path = None
+
+
 class PhotoEditor:
-    def __init__(self, root):
+    def __init__(self, root, report_startup=False):
+        self.report_startup = report_startup  # print the startup timings, see --startup-report
+        self.startup_report = {"imports_ms": (time.perf_counter() - _STARTUP_START) * 1000}
         self.root = root
         self.root.title("Photo Editor")
         self.root.geometry("800x600")
@@ -65,8 +2026,14 @@ class PhotoEditor:
         # File menu
         file_menu = tk.Menu(menubar, tearoff=0)
         file_menu.add_command(label="Open\tCtrl+O", command=self.open_image)
+        file_menu.add_command(label="Open Folder\tCtrl+Shift+O", command=self.open_folder)
         file_menu.add_command(label="Capture\tCtrl+C", command=self.capture_photo)
+        self.live_look_var = tk.BooleanVar(value=False)
+        file_menu.add_checkbutton(label="Live Look While Capturing", variable=self.live_look_var)
+        self.burst_var = tk.BooleanVar(value=False)
+        file_menu.add_checkbutton(label="Burst Capture (Keep Sharpest)", variable=self.burst_var)
         file_menu.add_command(label="Save\tCtrl+S", command=self.save_image)
+        file_menu.add_command(label="Export Web Sizes\tCtrl+E", command=self.export_web_sizes)
         file_menu.add_separator()
         file_menu.add_command(label="Exit\tCtrl+Q", command=self.exit_program)
         menubar.add_cascade(label="File", menu=file_menu)
@@ -79,6 +2046,28 @@ class PhotoEditor:
         edit_menu.add_command(label="Revert to original\tCtrl+G", command=self.revert_to_original)
         menubar.add_cascade(label="Edit", menu=edit_menu)
 
+        # View menu
+        view_menu = tk.Menu(menubar, tearoff=0)
+        self.viewport_render_var = tk.BooleanVar(value=True)
+        view_menu.add_checkbutton(label="Viewport-Only Rendering When Zoomed", variable=self.viewport_render_var,
+                                  command=self.toggle_viewport_rendering)
+        self.show_faces_var = tk.BooleanVar(value=False)
+        view_menu.add_checkbutton(label="Show Faces", variable=self.show_faces_var, command=self.toggle_face_boxes)
+        view_menu.add_separator()
+        self.compare_var = tk.BooleanVar(value=False)
+        view_menu.add_checkbutton(label="Compare Before/After\tCtrl+B", variable=self.compare_var,
+                                  command=self.toggle_compare)
+        self.compare_layout_var = tk.StringVar(value="split")
+        view_menu.add_radiobutton(label="Split With Divider", value="split", variable=self.compare_layout_var,
+                                  command=self.show_compare)
+        view_menu.add_radiobutton(label="Side by Side", value="side", variable=self.compare_layout_var,
+                                  command=self.show_compare)
+        menubar.add_cascade(label="View", menu=view_menu)
+
+        # Documents menu, rebuilt each time it opens
+        self.documents_menu = tk.Menu(menubar, tearoff=0, postcommand=self.refresh_documents_menu)
+        menubar.add_cascade(label="Documents", menu=self.documents_menu)
+
         # Help menu
         help_menu = tk.Menu(menubar, tearoff=0)
         help_menu.add_command(label="About\tF1", command=self.show_about)
@@ -86,13 +2075,19 @@ class PhotoEditor:
 
         # bind keyboard shortcuts
         self.root.bind_all("<Control-o>", lambda event: self.open_image())
+        self.root.bind_all("<Control-O>", lambda event: self.open_folder())
         self.root.bind_all("<Control-c>", lambda event: self.capture_photo())
         self.root.bind_all("<Control-s>", lambda event: self.save_image())
+        self.root.bind_all("<Control-e>", lambda event: self.export_web_sizes())
         self.root.bind_all("<Control-z>", lambda event: self.undo())
         self.root.bind_all("<Control-y>", lambda event: self.redo())
         self.root.bind_all("<Control-g>", lambda event: self.revert_to_original())
         self.root.bind_all("<Control-q>", lambda event: self.exit_program())
+        self.root.bind_all("<Control-Tab>", lambda event: self.next_document() or "break")
+        self.root.bind_all("<Control-w>", lambda event: self.close_document())
         self.root.bind_all("<F1>", lambda event: self.show_about())
+        self.root.bind_all("<Control-b>", lambda event: self.compare_var.set(not self.compare_var.get())
+                           or self.toggle_compare())
 
         # Set the menu bar
         self.root.config(menu=menubar)
@@ -102,16 +2097,50 @@ class PhotoEditor:
         self.history_stack = []  # For undo
         self.history_redo_stack = []  # For redo
 
+        # Open documents; history_stack and friends above always belong to the active one
+        self.documents = DocumentCache()
+        self.active_document = None
+        self.active_document_var = tk.IntVar(value=0)
+
         self.start_x = self.start_y = self.rect_id = None
 
         # Zoom attributes
         self.zoom_factor = 1.0
         self.min_zoom = 0.2
         self.max_zoom = 5.0
+
+        # Before/after comparison, drawn from screen-sized renders kept in compare_renders
+        self.compare_split = 0.5  # divider position as a fraction of the picture's width
+        self.compare_renders = {}  # "before"/"after" -> (images it was made from, (key, size), image)
+        self.compare_origin = None  # (x, y, width) of the split picture on the canvas
         self.canvas_offset = [0, 0]  # [x_offset, y_offset]
         self.brightness = 1.0
         self.contrast = 1.0
 
+        # Render bookkeeping, bumped whenever self.image holds a new render
+        self.render_version = 0
+        self.render_stats = None
+        self.histogram_version = -1
+        self.prefilter_image = None
+
+        # Zoomed in, only the visible part is rendered and self.image holds an outdated full render
+        self.render_size = None  # size of the current render, known even when it is stale
+        self.render_stale = False
+        self.contrast_mean = None  # luminance mean the region renders use for contrast
+        self.viewport_cache = None  # (left, upper, right, lower, image) of the last region render
+        self.render_cache = RenderCache()
+
+        # Big renders run in worker processes, the source pixels are shared with them, not sent
+        self.render_workers = None  # started in the background after the first frame, see tune_backends
+        self.shared_source = None  # SharedImage of what the current renders start from
+        self.worker_jobs = []  # (future, SharedImage) of every worker render not yet collected
+        self.render_job = None  # (future, finished proxy, its stats) of the render the view waits for
+
+        # Filter gallery previews, rendered on a small thread pool
+        self.preview_pool = ThreadPoolExecutor(max_workers=GALLERY_WORKERS)
+        self.gallery_key = None
+        self.gallery_jobs = None
+
         # Canvas
         self.canvas = tk.Canvas(root, width=600, height=400, bg='gray')
         self.canvas.pack(pady=20)
@@ -119,6 +2148,13 @@ class PhotoEditor:
         self.canvas.bind("<B1-Motion>", self.on_mouse_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_mouse_release)
 
+        # Middle-button drag pans
+        self.canvas.bind("<ButtonPress-2>", self.on_pan_start)
+        self.canvas.bind("<B2-Motion>", self.on_pan_drag)
+        self.canvas.bind("<ButtonRelease-2>", self.on_pan_end)
+        self.pan_last = None
+        self.display_buffer = None  # (left, upper, image) shown on the canvas, in zoomed pixels
+
         self.canvas.config(cursor="arrow")
         self.canvas_tooltip = ToolTip(self.canvas, "Drag your mouse to crop the image")
 
@@ -133,6 +2169,7 @@ class PhotoEditor:
         # Drawing attributes
         self.drawing_enabled = False
         self.last_draw_pos = None
+        self.current_stroke = None
         self.brush_size = 3
         self.brush_color = "black"
 
@@ -141,6 +2178,15 @@ class PhotoEditor:
         self.text_font_size = 20
         self.text_color = "black"
         self.text_overlay = None  # To hold the current text input widget temporarily
+        self.color_pick_mode = False  # next click on the image sets the color to replace
+
+        # Local adjustment layers, strokes go to self.local_layer while it is the latest edit
+        self.local_layer = None
+        self.local_layer_ids = itertools.count(1)
+
+        # Folder filmstrip, packed at the bottom once a folder is opened
+        self.filmstrip = FilmstripPanel(root, on_select=self.open_path)
+        self.filmstrip_visible = False
 
         # Radiobuttons
         category_frame = tk.Frame(root)
@@ -175,6 +2221,8 @@ class PhotoEditor:
         tk.Button(button_row, text="Rotate", command=self.append_rotate).pack(side="left", padx=5)
         tk.Button(button_row, text="Flip Horizontal", command=self.flip_horizontal).pack(side="left", padx=5)
         tk.Button(button_row, text="Flip Vertical", command=self.flip_vertical).pack(side="left", padx=5)
+        tk.Button(button_row, text="Resize...", command=self.append_resize).pack(side="left", padx=5)
+        tk.Button(button_row, text="Auto-Crop to Faces", command=self.auto_crop_faces).pack(side="left", padx=5)
         button_row.pack(pady=(0, 10))
         self.crop_controls = tk.Frame(transform_frame)
         tk.Button(self.crop_controls, text="Apply Crop", command=self.append_crop).pack(side="left", padx=5)
@@ -193,24 +2241,30 @@ class PhotoEditor:
 
         # Filters
         filters_frame = tk.Frame(self.tools_container)
+        filter_row = tk.Frame(filters_frame)
 
         self.filter_buttons = {}
 
-        self.filter_buttons["grayscale"] = tk.Button(filters_frame, text="Grayscale", command=self.apply_grayscale)
+        self.filter_buttons["grayscale"] = tk.Button(filter_row, text="Grayscale", command=self.apply_grayscale)
         self.filter_buttons["grayscale"].config(bg="light gray", fg="black")
         self.filter_buttons["grayscale"].pack(side="left", padx=5)
 
-        self.filter_buttons["sepia"] = tk.Button(filters_frame, text="Sepia", command=self.apply_sepia)
+        self.filter_buttons["sepia"] = tk.Button(filter_row, text="Sepia", command=self.apply_sepia)
         self.filter_buttons["sepia"].config(bg="light gray", fg="black")
         self.filter_buttons["sepia"].pack(side="left", padx=5)
 
-        self.filter_buttons["invert"] = tk.Button(filters_frame, text="Invert", command=self.apply_invert)
+        self.filter_buttons["invert"] = tk.Button(filter_row, text="Invert", command=self.apply_invert)
         self.filter_buttons["invert"].config(bg="light gray", fg="black")
         self.filter_buttons["invert"].pack(side="left", padx=5)
 
-        self.filter_buttons["blur"] = tk.Button(filters_frame, text="Blur", command=self.apply_blur)
+        self.filter_buttons["blur"] = tk.Button(filter_row, text="Blur", command=self.apply_blur)
         self.filter_buttons["blur"].config(bg="light gray", fg="black")
         self.filter_buttons["blur"].pack(side="left", padx=5)
+        filter_row.pack(pady=(0, 5))
+
+        # Live previews of every filter combination, clicking one applies it
+        self.filter_gallery = FilterGalleryPanel(filters_frame, on_select=self.apply_filter_combination)
+        self.filter_gallery.pack()
 
         self.tool_frames["Filters"] = filters_frame
 
@@ -224,22 +2278,44 @@ class PhotoEditor:
 
         # Tone adjustments
         tone_frame = tk.Frame(self.tools_container)
+        sliders_frame = tk.Frame(tone_frame)
 
         # Brightness slider
-        tk.Label(tone_frame, text="Brightness").pack(side="top", pady=2)
-        self.brightness_slider = ttk.Scale(tone_frame, from_=0.5, to=1.5, orient='horizontal', value=1.0)
+        tk.Label(sliders_frame, text="Brightness").pack(side="top", pady=2)
+        self.brightness_slider = ttk.Scale(sliders_frame, from_=0.5, to=1.5, orient='horizontal', value=1.0)
         self.brightness_slider.pack(side="top", fill="x", padx=10)
 
         # Contrast slider
-        tk.Label(tone_frame, text="Contrast").pack(side="top", pady=2)
-        self.contrast_slider = ttk.Scale(tone_frame, from_=0.5, to=1.5, orient='horizontal', value=1.0)
+        tk.Label(sliders_frame, text="Contrast").pack(side="top", pady=2)
+        self.contrast_slider = ttk.Scale(sliders_frame, from_=0.5, to=1.5, orient='horizontal', value=1.0)
         self.contrast_slider.pack(side="top", fill="x", padx=10)
 
+        # Local adjustment, painted on with the brush while Paint Mask is on
+        local_frame = tk.Frame(sliders_frame)
+        self.local_paint_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(local_frame, text="Paint Mask", variable=self.local_paint_var,
+                        command=self.toggle_local_paint).pack(side="left", padx=5)
+        tk.Button(local_frame, text="New Layer", command=self.new_local_layer).pack(side="left", padx=5)
+        local_frame.pack(side="top", pady=(6, 0))
+        tk.Label(sliders_frame, text="Local Brightness").pack(side="top", pady=2)
+        self.local_brightness_slider = ttk.Scale(sliders_frame, from_=0.5, to=2.0, orient='horizontal', value=1.3)
+        self.local_brightness_slider.pack(side="top", fill="x", padx=10)
+        tk.Label(sliders_frame, text="Local Contrast").pack(side="top", pady=2)
+        self.local_contrast_slider = ttk.Scale(sliders_frame, from_=0.5, to=1.5, orient='horizontal', value=1.0)
+        self.local_contrast_slider.pack(side="top", fill="x", padx=10)
+        sliders_frame.pack(side="left", fill="x")
+
+        # Histogram next to the sliders
+        self.histogram_panel = HistogramPanel(tone_frame)
+        self.histogram_panel.pack(side="left", padx=10)
+
         # Bind same update logic
         # self.brightness_slider.config(command=self.preview_tone_adjustments)
         # self.contrast_slider.config(command=self.preview_tone_adjustments)
         self.brightness_slider.bind("<ButtonRelease-1>", self.append_tone)
         self.contrast_slider.bind("<ButtonRelease-1>", self.append_tone)
+        self.local_brightness_slider.bind("<ButtonRelease-1>", self.append_local_tone)
+        self.local_contrast_slider.bind("<ButtonRelease-1>", self.append_local_tone)
 
         self.tool_frames["Tone"] = tone_frame
 
@@ -274,6 +2350,27 @@ class PhotoEditor:
         tk.Entry(text_frame, textvariable=self.text_color_var, width=8).pack(side="left", padx=5)
         text_frame.pack(pady=(0, 10))
 
+        # Color replacement, the from color can be typed or picked off the image
+        color_frame = tk.Frame(extra_frame)
+        tk.Label(color_frame, text="Replace:").pack(side="left", padx=5)
+        self.replace_from_var = tk.StringVar(value="#ffffff")
+        tk.Entry(color_frame, textvariable=self.replace_from_var, width=8).pack(side="left")
+        tk.Button(color_frame, text="Pick", command=self.activate_color_pick).pack(side="left", padx=(2, 5))
+        tk.Label(color_frame, text="With:").pack(side="left")
+        self.replace_to_var = tk.StringVar(value="#000000")
+        tk.Entry(color_frame, textvariable=self.replace_to_var, width=8).pack(side="left", padx=5)
+        tk.Label(color_frame, text="Tolerance:").pack(side="left")
+        self.replace_tolerance_slider = ttk.Scale(color_frame, from_=0, to=100, orient='horizontal', length=80)
+        self.replace_tolerance_slider.pack(side="left", padx=5)
+        tk.Label(color_frame, text="Softness:").pack(side="left")
+        self.replace_softness_slider = ttk.Scale(color_frame, from_=0, to=50, orient='horizontal', length=80)
+        self.replace_softness_slider.pack(side="left", padx=5)
+        self.replace_space_var = tk.StringVar(value="rgb")
+        ttk.Radiobutton(color_frame, text="RGB", value="rgb", variable=self.replace_space_var).pack(side="left")
+        ttk.Radiobutton(color_frame, text="Lab", value="lab", variable=self.replace_space_var).pack(side="left")
+        tk.Button(color_frame, text="Replace Color", command=self.append_color).pack(side="left", padx=5)
+        color_frame.pack(pady=(0, 10))
+
         # confirmation button
         # button_frame = tk.Frame(extra_frame)
         # tk.Button(button_frame, text="Confirm", command=self.confirm_changes).pack(side="left", padx=5)
@@ -281,31 +2378,81 @@ class PhotoEditor:
         # button_frame.pack(pady=(0, 10))
         self.tool_frames["Extra"] = extra_frame
 
-        # Load last session image
-        if os.path.exists("last_session_image.jpg"):
-            if messagebox.askyesno("Load image", "Do you want to load the image from the last session?"):
-                self.image = Image.open("last_session_image.jpg")
-                self.original_image = self.image.copy()
-                self.pre_overlay_image = self.image.copy()
-                self.history_stack.clear()
-                self.history_redo_stack.clear()
-                self.brightness_slider.set(1.0)
-                self.contrast_slider.set(1.0)
-                self.reset_filter_states()
-                self.update_filter_button_colors()
-                self.update_filtered_image()
-                self.set_category_buttons_state("normal")
-                self.set_all_controls_state("normal")
-                self.root.after(100, self.reset_zoom())
-            else:
-                self.set_category_buttons_state("disabled")
-                self.set_all_controls_state("disabled")
-                self.canvas_tooltip.disable()
-                self.canvas.create_text(300, 200, text="Load or capture an image to begin.", fill="white",
-                                        font=("Arial", 16))
-
         self.update_button_frame()
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        # Loaded on first capture, see get_face_cascade
+        self.face_cascade = None
+
+        # The last session is restored once the window is on screen
+        self.restore_queue = queue.Queue()
+        self.startup_report["ui_ms"] = (time.perf_counter() - _STARTUP_START) * 1000
+        self.first_frame_binding = self.root.bind("<Map>", self.on_first_frame, add="+")
+
+    # startup functions
+
+    def on_first_frame(self, event):
+        # The window is on screen once it is mapped; the widgets draw in the idle handlers
+        # that mapping queued, which update_idletasks runs before the time is taken
+        if event.widget is not self.root:
+            return
+        self.root.unbind("<Map>", self.first_frame_binding)
+        self.root.update_idletasks()
+        self.startup_report["first_frame_ms"] = (time.perf_counter() - _STARTUP_START) * 1000
+        if self.report_startup:
+            self.print_startup_report()
+        self.root.after(0, self.restore_last_session)
+        # reading the saved tuning and spawning the render workers never hold up the window
+        threading.Thread(target=self.tune_backends, daemon=True).start()
+
+    def tune_backends(self):
+        load_backend_tuning()
+        try:
+            workers = start_render_workers()
+            workers.submit(int).result()  # spawning takes a moment, better now than on the first edit
+        except (OSError, ImportError):
+            return  # no shared memory here, renders stay in this process
+        self.render_workers = workers
+
+    def print_startup_report(self):
+        report = self.startup_report
+        status = "ok" if report["first_frame_ms"] <= STARTUP_TARGET_MS else "over target"
+        print(f"Startup: imports {report['imports_ms']:.0f} ms, UI built {report['ui_ms']:.0f} ms, "
+              f"first frame {report['first_frame_ms']:.0f} ms (target {STARTUP_TARGET_MS} ms, {status})")
+
+    def restore_last_session(self):
+        if not os.path.exists(LAST_SESSION_PATH):
+            return
+        if messagebox.askyesno("Load image", "Do you want to load the image from the last session?"):
+            self.canvas.create_text(300, 200, text="Loading last session...", fill="white", font=("Arial", 16))
+            threading.Thread(target=self.decode_last_session, daemon=True).start()
+            self.root.after(20, self.poll_last_session)
+        else:
+            self.set_category_buttons_state("disabled")
+            self.set_all_controls_state("disabled")
+            self.canvas_tooltip.disable()
+            self.canvas.create_text(300, 200, text="Load or capture an image to begin.", fill="white",
+                                    font=("Arial", 16))
+
+    def decode_last_session(self):
+        # Runs off the Tk thread, only hands the decoded image back
+        try:
+            with Image.open(LAST_SESSION_PATH) as img:
+                img.load()
+                self.restore_queue.put(img.copy())
+        except OSError:
+            self.restore_queue.put(None)
+
+    def poll_last_session(self):
+        try:
+            img = self.restore_queue.get_nowait()
+        except queue.Empty:
+            self.root.after(20, self.poll_last_session)
+            return
+        if img is None or self.image:
+            # unreadable file, or the user already opened something else meanwhile
+            if not self.image:
+                self.canvas.delete("all")
+            return
+        self.open_document(img, "Last session")
 
     # utility functions
 
@@ -320,6 +2467,10 @@ class PhotoEditor:
         for frame in self.tool_frames.values():
             frame.pack_forget()
         self.tool_frames[selected].pack()
+        if selected == "Tone":
+            self.update_histogram()
+        elif selected == "Filters":
+            self.refresh_filter_gallery()
 
     def set_category_buttons_state(self, state):
         for btn in self.category_buttons:
@@ -336,6 +2487,25 @@ class PhotoEditor:
         for frame in self.tool_frames.values():
             self.set_state_recursive(frame, state)
 
+    def mark_render_changed(self, stats=None):
+        # stats: statistics of the new render if the pipeline already measured them
+        self.render_version += 1
+        self.render_stats = stats
+        if self.option_var.get() == "Tone":
+            self.update_histogram()
+        elif self.option_var.get() == "Filters":
+            self.refresh_filter_gallery()
+
+    def update_histogram(self):
+        # Only recomputed when the render changed, never on zoom or redraw
+        if not self.image or self.histogram_version == self.render_version:
+            return
+        stats = self.render_stats
+        if stats is None:
+            stats = image_statistics(sample_for_statistics(self.image))
+        self.histogram_panel.update(stats)
+        self.histogram_version = self.render_version
+
     def reset_filter_states(self):
         self.filter_states = {
             "grayscale": False,
@@ -385,21 +2555,171 @@ class PhotoEditor:
         self.contrast_slider.set(1.0)
         path = filedialog.askopenfilename(filetypes=[("Image files", "*.png *.jpg *.jpeg")])
         if path:
-            self.image = Image.open(path)
-            self.original_image = self.image.copy()
-            self.pre_overlay_image = self.image.copy()
-            self.history_stack.clear()
-            self.history_redo_stack.clear()
-            self.brightness_slider.set(1.0)
-            self.contrast_slider.set(1.0)
-            self.reset_filter_states()
+            self.open_path(path)
+
+    def open_path(self, path):
+        for doc in self.documents:
+            if doc.path == path:
+                # already open, switching is cheaper than decoding again
+                self.switch_document(doc)
+                return
+        with Image.open(path) as img:
+            img.load()
+            self.open_document(img.copy(), os.path.basename(path), path)
+
+    def open_folder(self):
+        folder = filedialog.askdirectory()
+        if not folder:
+            return
+        if not self.filmstrip_visible:
+            # grow the window to make room instead of squeezing the tools
+            self.root.geometry(f"{self.root.winfo_width()}x{self.root.winfo_height() + 140}")
+            self.filmstrip.pack(side="bottom", fill="x")
+            self.filmstrip_visible = True
+        self.filmstrip.show_folder(folder)
+
+    # document functions
+
+    def open_document(self, img, name, path=None):
+        self.store_active_document()
+        img, alpha = to_working_format(img)
+        doc = Document(name, img, path, alpha)
+        self.documents.add(doc)
+        self.documents.activate(doc)
+        self.activate_document(doc)
+
+        self.image = img
+        self.prefilter_image = img
+        self.render_size = img.size
+        self.render_stale = False
+        self.render_job = None
+        self.brightness_slider.set(1.0)
+        self.contrast_slider.set(1.0)
+        self.reset_filter_states()
+        self.update_filter_button_colors()
+        self.update_filtered_image()
+        doc.render = self.image
+        doc.prefilter = img
+        self.set_category_buttons_state("normal")
+        self.set_all_controls_state("normal")
+        if self.option_var.get() == "Transform":
+            self.canvas_tooltip.enable()
+        self.reset_zoom()
+        self.mark_render_changed()
+
+    def activate_document(self, doc):
+        # the editor works directly on the document's lists, so nothing needs copying back
+        self.active_document = doc
+        self.original_image = doc.original_image
+        self.history_stack = doc.history_stack
+        self.history_redo_stack = doc.history_redo_stack
+        self.root.title(f"Photo Editor - {doc.name}")
+        self.retire_shared_source()  # the previous document's pixels, if a worker had them
+        self.gallery_key = None  # would keep the previous document's original alive through a spill
+        if self.show_faces_var.get():
+            self.request_faces()
+        # spill other documents only after the switch has been drawn
+        self.root.after_idle(self.enforce_document_budget)
+
+    def enforce_document_budget(self):
+        self.documents.enforce_budget(keep=self.active_document)
+
+    def store_active_document(self):
+        if self.active_document is not None:
+            # a stale render is worthless, switching back replays the history instead
+            self.active_document.render = None if self.render_stale else self.image
+            self.active_document.prefilter = None if self.render_stale else self.prefilter_image
+
+    def document_proxy(self):
+        # the proxy and its size relative to the original
+        doc = self.active_document
+        if doc.proxy is None:
+            doc.proxy = self.original_image.copy()
+            doc.proxy.thumbnail((PROXY_SIZE, PROXY_SIZE))
+        return doc.proxy, doc.proxy.size[0] / self.original_image.size[0]
+
+    def switch_document(self, doc):
+        if doc is self.active_document:
+            return
+        self.store_active_document()
+        self.pending_crop_box = None
+        self.crop_controls.pack_forget()
+        self.clear_crop_overlay()
+        self.documents.activate(doc)
+        self.activate_document(doc)
+
+        if doc.render is None:
+            # the zoom still belongs to the previous document, so no region render
+            self.apply_all_edits(full=True)
+        else:
+            self.image = doc.render
+            self.prefilter_image = doc.prefilter
+            self.render_size = doc.render.size
+            self.render_stale = False
+            self.render_job = None
+            self.viewport_cache = None
+            self.load_edit_state()
             self.update_filter_button_colors()
-            self.update_filtered_image()
-            self.set_category_buttons_state("normal")
-            self.set_all_controls_state("normal")
-            if self.option_var.get() == "Transform":
-                self.canvas_tooltip.enable()
-            self.reset_zoom()
+            self.brightness_slider.set(self.brightness)
+            self.contrast_slider.set(self.contrast)
+            self.mark_render_changed()
+        self.reset_zoom()
+
+    def next_document(self):
+        # least recently used first, so this cycles through every open document
+        docs = list(self.documents)
+        if len(docs) > 1:
+            self.switch_document(docs[0])
+
+    def close_document(self):
+        doc = self.active_document
+        if doc is None:
+            return
+        self.documents.remove(doc)
+        self.active_document = None
+        remaining = self.documents.most_recent()
+        if remaining is not None:
+            self.switch_document(remaining)
+            return
+
+        self.image = None
+        self.original_image = None
+        self.prefilter_image = None
+        self.render_size = None
+        self.render_stale = False
+        self.render_job = None
+        self.viewport_cache = None
+        self.display_buffer = None
+        self.history_stack = []
+        self.history_redo_stack = []
+        self.pending_crop_box = None
+        self.crop_controls.pack_forget()
+        self.canvas.delete("all")
+        self.root.title("Photo Editor")
+        self.set_category_buttons_state("disabled")
+        self.set_all_controls_state("disabled")
+        self.canvas_tooltip.disable()
+        self.canvas.create_text(300, 200, text="Load or capture an image to begin.", fill="white",
+                                font=("Arial", 16))
+
+    def refresh_documents_menu(self):
+        menu = self.documents_menu
+        menu.delete(0, "end")
+        menu.add_command(label="Next Document\tCtrl+Tab", command=self.next_document)
+        menu.add_command(label="Close Document\tCtrl+W", command=self.close_document)
+        if not len(self.documents):
+            return
+        menu.add_separator()
+        self.active_document_var.set(id(self.active_document))
+        for doc in self.documents:
+            label = doc.name + (" (on disk)" if doc.spilled else "")
+            menu.add_radiobutton(label=label, variable=self.active_document_var, value=id(doc),
+                                 command=lambda d=doc: self.switch_document(d))
+
+    def get_face_cascade(self):
+        if self.face_cascade is None:
+            self.face_cascade = new_face_cascade()
+        return self.face_cascade
 
     def capture_photo(self):
         self.brightness_slider.set(1.0)
@@ -414,6 +2734,11 @@ class PhotoEditor:
         loading_win.grab_set()
         loading_win.update()
 
+        cv2 = load_cv2()
+        face_cascade = self.get_face_cascade()
+        # Snapshot the current look, opening the capture as a new document resets it
+        look_state = (copy.deepcopy(self.filter_states), self.brightness, self.contrast)
+        look = make_live_look(*look_state)
         cap = cv2.VideoCapture(0)
         if not cap.isOpened():
             messagebox.showerror("Error", "Webcam not found.")
@@ -422,97 +2747,340 @@ class PhotoEditor:
 
         loading_win.destroy()
 
-        messagebox.showinfo("Webcam", "Press SPACE to capture, ESC to cancel.")
+        messagebox.showinfo("Webcam", "Press SPACE to capture, L to toggle the live look, ESC to cancel.")
+        burst = None
         while True:
-            ret, frame = cap.read()
+            if burst is not None:
+                frame = burst.read(cap)
+                ret = frame is not None
+            else:
+                ret, frame = cap.read()
+                if ret and self.burst_var.get():
+                    burst = BurstBuffer(frame.shape)
             if not ret:
                 break
 
-            # Convert to grayscale for face detection
+            # Convert to grayscale for face detection, at half size which is plenty for a Haar cascade
             gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
+            gray = cv2.resize(gray, (gray.shape[1] // 2, gray.shape[0] // 2), interpolation=cv2.INTER_AREA)
+            faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
 
             # Draw rectangles around detected faces - Make a copy for display (with rectangles)
-            display_frame = frame.copy()
+            display_frame = look(frame) if self.live_look_var.get() else frame.copy()
             for (x, y, w, h) in faces:
-                cv2.rectangle(display_frame, (x, y), (x + w, y + h), (255, 255, 255), 2)
+                cv2.rectangle(display_frame, (2 * x, 2 * y), (2 * (x + w), 2 * (y + h)), (255, 255, 255), 2)
 
             cv2.imshow("Press SPACE to capture", display_frame)
 
             key = cv2.waitKey(1)
-            if key == 27:  # ESC to cancel
+            if key in (ord("l"), ord("L")):
+                self.live_look_var.set(not self.live_look_var.get())
+            elif key == 27:  # ESC to cancel
                 cap.release()
                 cv2.destroyAllWindows()
+                if burst is not None:
+                    burst.close()
                 return
             elif key == 32:  # SPACE to capture
-                cv2.imwrite("captured_webcam_image.jpg", frame)
+                if burst is not None:
+                    # the sharpest of the last few frames rather than whichever was on screen,
+                    # which is all there is when SPACE comes before the ring got its first frame
+                    sharpest = burst.sharpest()
+                    if sharpest is not None:
+                        frame = sharpest
+                    burst.close()
                 cap.release()
                 cv2.destroyAllWindows()
-                with Image.open("captured_webcam_image.jpg") as img:
-                    self.image = img.copy()
-                os.remove("captured_webcam_image.jpg")  # delete immediately after loading
-                self.original_image = self.image.copy()
-                self.pre_overlay_image = self.image.copy()
-                self.history_stack.clear()
-                self.history_redo_stack.clear()
-                self.brightness_slider.set(1.0)
-                self.contrast_slider.set(1.0)
-                self.reset_filter_states()
-                self.update_filter_button_colors()
-                self.update_filtered_image()
-                self.set_category_buttons_state("normal")
-                self.set_all_controls_state("normal")
-                if self.option_var.get() == "Transform":
-                    self.canvas_tooltip.enable()
-                self.reset_zoom()
+                captured = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                self.open_document(captured, "Webcam capture")
+                if self.live_look_var.get():
+                    # keep the look that was previewed, as ordinary undoable edits
+                    filter_states, brightness, contrast = look_state
+                    if any(filter_states.values()):
+                        self.push_state("filter", {"filters": filter_states})
+                    if brightness != 1.0 or contrast != 1.0:
+                        self.push_state("tone", {"brightness": brightness, "contrast": contrast})
+                    if self.history_stack:
+                        self.apply_all_edits()
                 return
 
+    def canvas_size(self):
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+        if canvas_width <= 1 or canvas_height <= 1:
+            # This ensures the canvas is fully initialized
+            return 600, 400
+        return canvas_width, canvas_height
+
+    def update_displayed_image_info(self):
+        # Where the whole zoomed image sits on the canvas, for cropping and drawing
+        img_width, img_height = self.render_size
+        zoomed_width = int(img_width * self.zoom_factor)
+        zoomed_height = int(img_height * self.zoom_factor)
+        self.displayed_image_info = {
+            "x": self.canvas_offset[0],
+            "y": self.canvas_offset[1],
+            "width": zoomed_width,
+            "height": zoomed_height,
+            "scale_x": img_width / zoomed_width,
+            "scale_y": img_height / zoomed_height
+        }
+
     def display_image(self):
-        if self.image:
-            img = self.image.copy()
-            img_width, img_height = img.size
+        if self.image and self.compare_var.get():
+            self.show_compare()
+        elif self.image:
+            canvas_width, canvas_height = self.canvas_size()
+            self.update_displayed_image_info()
+
+            # Clear previews and the crop box, the picture item itself is refreshed in place
+            for item in self.canvas.find_all():
+                if item != self.canvas_image_id:
+                    self.canvas.delete(item)
+            self.display_buffer = None
+            visible = self.visible_region(canvas_width, canvas_height)
+            if visible is None:
+                if self.canvas_image_id is not None:
+                    self.canvas.itemconfigure(self.canvas_image_id, state="hidden")
+                return  # panned entirely off the canvas
+            if self.render_stale and self.render_job is None and not self.viewport_worthwhile(canvas_width,
+                                                                                               canvas_height):
+                self.ensure_full_render()
+                return
+            self.show_display_buffer(self.display_buffer_rect(visible, canvas_width, canvas_height))
+            self.draw_face_boxes()
+
+    def display_buffer_rect(self, visible, canvas_width, canvas_height):
+        # The view plus a margin for panning, in zoomed pixels. The size only depends on the
+        # zoom, so the PhotoImage can be refilled in place as the view moves.
+        zoomed_width = self.displayed_image_info["width"]
+        zoomed_height = self.displayed_image_info["height"]
+        margin_x, margin_y = int(canvas_width * PAN_MARGIN), int(canvas_height * PAN_MARGIN)
+        width = min(zoomed_width, canvas_width + 2 * margin_x)
+        height = min(zoomed_height, canvas_height + 2 * margin_y)
+        left = min(max(0, visible[0] - margin_x), zoomed_width - width)
+        upper = min(max(0, visible[1] - margin_y), zoomed_height - height)
+        return left, upper, left + width, upper + height
+
+    def render_display(self, rect):
+        # Part of the zoomed image, rect in zoomed pixels
+        left, upper, right, lower = rect
+        zoom = self.zoom_factor
+        box = (left / zoom, upper / zoom, right / zoom, lower / zoom)
+        if self.render_job is not None:
+            # a worker is still rendering, the finished proxy stands in meanwhile
+            source = self.render_job[1]
+            scale_x, scale_y = source.size[0] / self.render_size[0], source.size[1] / self.render_size[1]
+            box = (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+        elif self.render_stale:
+            source, origin = self.viewport_source(box)
+            box = (box[0] - origin[0], box[1] - origin[1], box[2] - origin[0], box[3] - origin[1])
+        else:
+            source = self.image
+        return source.resize((right - left, lower - upper), Image.Resampling.LANCZOS, box=box)
+
+    def show_display_buffer(self, rect, previous=None):
+        # previous: the buffer before a pan, whatever it still covers is copied instead of rendered
+        left, upper, right, lower = rect
+        if previous is None:
+            img = self.render_display(rect)
+        else:
+            old_left, old_upper, old_img = previous
+            img = Image.new(old_img.mode, (right - left, lower - upper))
+            img.paste(old_img, (old_left - left, old_upper - upper))
+            # the overlap with the old buffer, clamped so empty strips come out empty
+            inner_left = min(max(old_left, left), right)
+            inner_upper = min(max(old_upper, upper), lower)
+            inner_right = max(min(old_left + old_img.width, right), inner_left)
+            inner_lower = max(min(old_upper + old_img.height, lower), inner_upper)
+            strips = [(left, upper, right, inner_upper), (left, inner_lower, right, lower),
+                      (left, inner_upper, inner_left, inner_lower), (inner_right, inner_upper, right, inner_lower)]
+            for strip in strips:
+                if strip[2] > strip[0] and strip[3] > strip[1]:
+                    img.paste(self.render_display(strip), (strip[0] - left, strip[1] - upper))
+        self.display_buffer = (left, upper, img)
+
+        if self.tk_image is not None and (self.tk_image.width(), self.tk_image.height()) == img.size:
+            self.tk_image.paste(img)
+        else:
+            self.tk_image = ImageTk.PhotoImage(img)
+        x, y = self.canvas_offset[0] + left, self.canvas_offset[1] + upper
+        if self.canvas_image_id is not None and self.canvas.find_withtag(self.canvas_image_id):
+            self.canvas.coords(self.canvas_image_id, x, y)
+            self.canvas.itemconfigure(self.canvas_image_id, image=self.tk_image, state="normal")
+        else:
+            self.canvas_image_id = self.canvas.create_image(x, y, anchor="nw", image=self.tk_image)
+
+    def visible_region(self, canvas_width, canvas_height):
+        # Part of the zoomed image on the canvas, in zoomed pixels
+        zoomed_width = int(self.render_size[0] * self.zoom_factor)
+        zoomed_height = int(self.render_size[1] * self.zoom_factor)
+        x, y = int(self.canvas_offset[0]), int(self.canvas_offset[1])
+        left, upper = max(0, -x), max(0, -y)
+        right, lower = min(zoomed_width, canvas_width - x), min(zoomed_height, canvas_height - y)
+        if right <= left or lower <= upper:
+            return None
+        return left, upper, right, lower
+
+    def viewport_worthwhile(self, canvas_width, canvas_height):
+        # True when so little of the image is on screen that rendering just that part pays off
+        if not self.viewport_render_var.get():
+            return False
+        visible = self.visible_region(canvas_width, canvas_height)
+        if visible is None:
+            return True
+        left, upper, right, lower = visible
+        zoomed_area = self.render_size[0] * self.render_size[1] * self.zoom_factor ** 2
+        return (right - left) * (lower - upper) < VIEWPORT_RENDER_FRACTION * zoomed_area
+
+    def viewport_source(self, box):
+        # Region render covering box (render coordinates), reused while the view stays inside it
+        cached = self.viewport_cache
+        if cached is not None:
+            left, upper, right, lower, img = cached
+            if left <= box[0] and upper <= box[1] and box[2] <= right and box[3] <= lower:
+                return img, (left, upper)
+
+        # a margin around the view, so small zoom and pan steps need no new render
+        width, height = self.render_size
+        margin_x = int((box[2] - box[0]) * VIEWPORT_MARGIN) + 1
+        margin_y = int((box[3] - box[1]) * VIEWPORT_MARGIN) + 1
+        region = (max(0, int(box[0]) - margin_x), max(0, int(box[1]) - margin_y),
+                  min(width, int(box[2]) + 1 + margin_x), min(height, int(box[3]) + 1 + margin_y))
+        source, history = self.render_source()
+        img = render_region(source, history, region, self.filter_states,
+                            self.brightness, self.contrast, self.contrast_mean)
+        self.viewport_cache = region + (img,)
+        return img, region[:2]
+
+    def ensure_full_render(self):
+        # Anything that needs every pixel (save, export, zooming out) calls this first
+        if self.image and self.render_stale:
+            if self.render_job is not None:
+                self.finish_worker_render(self.render_job[0])
+            else:
+                self.apply_all_edits(full=True)
 
-            # Resize for zoom
-            zoomed_width = int(img_width * self.zoom_factor)
-            zoomed_height = int(img_height * self.zoom_factor)
-            img = img.resize((zoomed_width, zoomed_height), Image.Resampling.LANCZOS)
+    def toggle_viewport_rendering(self):
+        if not self.viewport_render_var.get():
+            self.ensure_full_render()
 
+    # comparison functions
+
+    def toggle_compare(self):
+        if not self.compare_var.get():
+            self.compare_renders.clear()  # the cached pictures hold on to old renders
+            self.compare_origin = None
+            self.canvas.delete("compare")
+        self.display_image()
+
+    def compare_picture(self, name, sources, key, size, render):
+        # The cached screen-sized picture if it was made from the same images (by identity), key and size
+        cached = self.compare_renders.get(name)
+        if cached is not None and cached[1] == (key, size) and same_objects(cached[0], sources):
+            return cached[2]
+        img = render()
+        if img.size != size:
+            img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        self.compare_renders[name] = (sources, (key, size), img)
+        return img
+
+    def compare_before(self, size):
+        """
+        The original with only the crops, turns, flips and resizes of the history, so it lines
+        up with the render. Shrunk from the proxy when that is big enough, never at full size.
+        """
+        geometry = [entry for entry in plan_history(self.history_stack) if entry["type"] in GEOMETRY_TYPES]
+        sources = (self.original_image,)
+
+        def render():
+            # k: size of the shrunk original relative to the original, the same factor render_stage takes
+            leading = geometry[0]["data"]["scale"] if geometry and geometry[0]["type"] == "resize" else 1.0
+            k = min(1.0, size[0] / self.render_size[0] * leading)
+            proxy, proxy_scale = self.document_proxy()
+            source, source_scale = (proxy, proxy_scale) if k <= proxy_scale else (self.original_image, 1.0)
+            width, height = source.size
+            small = source.resize((max(1, round(width * k / source_scale)), max(1, round(height * k / source_scale))),
+                                  Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+            return render_stage(small, geometry, k)
+        return self.compare_picture("before", sources, history_entry_bytes(geometry), size, render)
+
+    def compare_after(self, size):
+        # The current render; while only part of it exists (zoomed, or a worker busy) a proxy render
+        job = self.render_job
+        sources = (self.image, self.prefilter_image, job and job[0])
+
+        def render():
+            if job is not None:
+                return job[1]
+            if self.render_stale:
+                proxy, scale = self.document_proxy()
+                return render_proxy(proxy, scale, self.history_stack, self.filter_states,
+                                    self.brightness, self.contrast)[1]
+            return self.image
+        return self.compare_picture("after", sources, None, size, render)
+
+    def show_compare(self):
+        """
+        Before and after fitted to the canvas, split by a divider or side by side. Both come
+        from compare_renders, so moving the divider only pastes screen-sized pictures.
+        """
+        if not self.image or not self.compare_var.get():
+            return
+        canvas_width, canvas_height = self.canvas_size()
+        side_by_side = self.compare_layout_var.get() == "side"
+        room = (canvas_width - COMPARE_GAP) // 2 if side_by_side else canvas_width
+        fit = min(room / self.render_size[0], canvas_height / self.render_size[1], self.max_zoom)
+        size = (max(1, int(self.render_size[0] * fit)), max(1, int(self.render_size[1] * fit)))
+        before, after = self.compare_before(size), self.compare_after(size)
+        width, height = size
+
+        if side_by_side:
+            img = Image.new("RGB", (2 * width + COMPARE_GAP, height), (128, 128, 128))
+            img.paste(before, (0, 0))
+            img.paste(after, (width + COMPARE_GAP, 0))
+        else:
+            img = after.copy()
+            split = round(width * self.compare_split)
+            img.paste(before.crop((0, 0, split, height)), (0, 0))
+
+        for item in self.canvas.find_all():
+            if item != self.canvas_image_id:
+                self.canvas.delete(item)
+        self.display_buffer = None
+        if self.tk_image is not None and (self.tk_image.width(), self.tk_image.height()) == img.size:
+            self.tk_image.paste(img)
+        else:
             self.tk_image = ImageTk.PhotoImage(img)
-            self.canvas.delete("all")
-
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-
-            if canvas_width <= 1 or canvas_height <= 1:
-                # This ensures the canvas is fully initialized
-                canvas_width = 600
-                canvas_height = 400
-
-            # Default center if no offset
-            if not hasattr(self, "canvas_offset"):
-                self.canvas_offset = [canvas_width // 2 - zoomed_width // 2,
-                                      canvas_height // 2 - zoomed_height // 2]
-
-            # Draw image at offset
-            self.canvas_image_id = self.canvas.create_image(
-                self.canvas_offset[0], self.canvas_offset[1],
-                anchor="nw", image=self.tk_image
-            )
-
-            # Update displayed image info for cropping
-            self.displayed_image_info = {
-                "x": self.canvas_offset[0],
-                "y": self.canvas_offset[1],
-                "width": zoomed_width,
-                "height": zoomed_height,
-                "scale_x": self.image.size[0] / zoomed_width,
-                "scale_y": self.image.size[1] / zoomed_height
-            }
+        x, y = (canvas_width - img.width) // 2, (canvas_height - img.height) // 2
+        if self.canvas_image_id is not None and self.canvas.find_withtag(self.canvas_image_id):
+            self.canvas.coords(self.canvas_image_id, x, y)
+            self.canvas.itemconfigure(self.canvas_image_id, image=self.tk_image, state="normal")
+        else:
+            self.canvas_image_id = self.canvas.create_image(x, y, anchor="nw", image=self.tk_image)
+
+        label = {"fill": "white", "font": ("Arial", 11, "bold"), "tags": "compare"}
+        if side_by_side:
+            self.compare_origin = None
+            self.canvas.create_text(x + 6, y + 6, text="Before", anchor="nw", **label)
+            self.canvas.create_text(x + width + COMPARE_GAP + 6, y + 6, text="After", anchor="nw", **label)
+        else:
+            self.compare_origin = (x, y, width)
+            self.canvas.create_line(x + split, y, x + split, y + height, fill="white", width=2, tags="compare")
+            self.canvas.create_text(x + 6, y + 6, text="Before", anchor="nw", **label)
+            self.canvas.create_text(x + width - 6, y + 6, text="After", anchor="ne", **label)
+
+    def move_compare_divider(self, x):
+        if self.compare_origin is None:
+            return
+        left, _, width = self.compare_origin
+        self.compare_split = min(1.0, max(0.0, (x - left) / width))
+        self.show_compare()
 
     # zoom utility functions
 
     def on_mouse_wheel(self, event):
-        if not self.image:
+        if not self.image or self.compare_var.get():
             return
 
         # Determine zoom direction
@@ -539,11 +3107,54 @@ class PhotoEditor:
         self.zoom_factor = new_zoom
         self.display_image()
 
+    def on_pan_start(self, event):
+        # the comparison always fits the canvas, there is nothing to pan
+        self.pan_last = None if self.compare_var.get() else (event.x, event.y)
+
+    def on_pan_drag(self, event):
+        if not self.image or self.pan_last is None:
+            return
+        dx, dy = event.x - self.pan_last[0], event.y - self.pan_last[1]
+        self.pan_last = (event.x, event.y)
+        self.pan_by(dx, dy)
+
+    def on_pan_end(self, event):
+        self.pan_last = None
+
+    def pan_by(self, dx, dy):
+        # Moves the picture item, only margins the buffer doesn't cover yet are rendered
+        self.canvas_offset[0] += dx
+        self.canvas_offset[1] += dy
+        self.update_displayed_image_info()
+        self.canvas.move("faces", dx, dy)
+        if self.rect_id:
+            self.canvas.move(self.rect_id, dx, dy)
+            self.draw_crop_shade(*self.canvas.coords(self.rect_id))
+
+        canvas_width, canvas_height = self.canvas_size()
+        visible = self.visible_region(canvas_width, canvas_height)
+        buffer = self.display_buffer
+        if visible is None or buffer is None:
+            if self.canvas_image_id is not None:
+                self.canvas.move(self.canvas_image_id, dx, dy)
+            if buffer is None and visible is not None:
+                self.display_image()  # coming back from off the canvas
+            return
+        left, upper, img = buffer
+        if (left <= visible[0] and upper <= visible[1]
+                and visible[2] <= left + img.width and visible[3] <= upper + img.height):
+            self.canvas.move(self.canvas_image_id, dx, dy)
+            return
+        if self.render_stale and self.render_job is None and not self.viewport_worthwhile(canvas_width, canvas_height):
+            self.ensure_full_render()
+            return
+        self.show_display_buffer(self.display_buffer_rect(visible, canvas_width, canvas_height), buffer)
+
     def reset_zoom(self):
         if not self.image:
             return
 
-        img_width, img_height = self.image.size
+        img_width, img_height = self.render_size
         canvas_width = self.canvas.winfo_width()
         canvas_height = self.canvas.winfo_height()
 
@@ -568,7 +3179,17 @@ class PhotoEditor:
     def on_mouse_press(self, event):
         if not self.image:
             return  # Do nothing if no image is loaded
-        if self.option_var.get() == "Transform":
+        if self.compare_var.get():
+            self.move_compare_divider(event.x)
+            return
+        if self.option_var.get() == "Tone" and self.local_paint_var.get():
+            info = self.displayed_image_info
+            width = self.brush_size * LOCAL_BRUSH_SCALE * self.render_size[0] / info["width"]
+            self.last_draw_pos = (event.x, event.y)
+            x, y = self.canvas_to_image(event.x, event.y)
+            self.current_stroke = new_stroke(x, y, 255, max(1, round(width)))
+            self.stroke_end = (x, y)
+        elif self.option_var.get() == "Transform":
             # Cropping mode
             self.start_x = event.x
             self.start_y = event.y
@@ -579,10 +3200,14 @@ class PhotoEditor:
                 # self.rect_id = None
             self.rect_id = self.canvas.create_rectangle(self.start_x, self.start_y, self.start_x, self.start_y,
                                                         outline='black')
+        elif self.option_var.get() == "Extra" and self.color_pick_mode:
+            self.pick_color(event.x, event.y)
         elif self.option_var.get() == "Extra" and self.drawing_enabled:
             # Drawing mode
             self.last_draw_pos = (event.x, event.y)
-            self.current_stroke = []
+            x, y = self.canvas_to_image(event.x, event.y)
+            self.current_stroke = new_stroke(x, y, self.brush_color, self.brush_size)
+            self.stroke_end = (x, y)
         elif self.option_var.get() == "Extra" and self.text_mode:
             # Remove previous overlay if any
             if self.text_overlay:
@@ -612,6 +3237,9 @@ class PhotoEditor:
     def on_mouse_drag(self, event):
         if not self.image:
             return  # Do nothing if no image is loaded
+        if self.compare_var.get():
+            self.move_compare_divider(event.x)
+            return
         if self.option_var.get() == "Transform":
             end_x = event.x
             end_y = event.y
@@ -644,23 +3272,14 @@ class PhotoEditor:
             # Draw the main crop rectangle
             if self.rect_id:
                 self.canvas.coords(self.rect_id, self.start_x, self.start_y, end_x, end_y)
-
-                # Remove old overlays
-                for oid in self.crop_overlay_ids:
-                    self.canvas.delete(oid)
-                self.crop_overlay_ids.clear()
-
-                # Add new overlay rectangles
-                x1, y1 = min(self.start_x, end_x), min(self.start_y, end_y)
-                x2, y2 = max(self.start_x, end_x), max(self.start_y, end_y)
-                w, h = self.canvas.winfo_width(), self.canvas.winfo_height()
-
-                self.crop_overlay_ids.extend([
-                    self.canvas.create_rectangle(0, 0, w, y1, fill="black", stipple="gray25", width=0),
-                    self.canvas.create_rectangle(0, y1, x1, y2, fill="black", stipple="gray25", width=0),
-                    self.canvas.create_rectangle(x2, y1, w, y2, fill="black", stipple="gray25", width=0),
-                    self.canvas.create_rectangle(0, y2, w, h, fill="black", stipple="gray25", width=0)
-                ])
+                self.draw_crop_shade(self.start_x, self.start_y, end_x, end_y)
+        elif self.option_var.get() == "Tone" and self.current_stroke and self.last_draw_pos:
+            # the mask only shows once the stroke is done, meanwhile a see-through trail marks it
+            self.canvas.create_line(*self.last_draw_pos, event.x, event.y, width=self.brush_size * LOCAL_BRUSH_SCALE,
+                                    fill="white", stipple="gray25", capstyle=tk.ROUND)
+            self.last_draw_pos = (event.x, event.y)
+            self.stroke_end = self.canvas_to_image(event.x, event.y)
+            extend_stroke(self.current_stroke, *self.stroke_end)
         elif self.option_var.get() == "Extra" and self.drawing_enabled and self.last_draw_pos:
             x1, y1 = self.last_draw_pos
             x2, y2 = event.x, event.y
@@ -669,30 +3288,48 @@ class PhotoEditor:
                                     width=self.brush_size,
                                     fill=self.brush_color,
                                     capstyle=tk.ROUND, smooth=True)
-            # Draw on the PIL image as well
-            scale_x = self.image.size[0] / self.displayed_image_info["width"]
-            scale_y = self.image.size[1] / self.displayed_image_info["height"]
-
-            # Adjust coords relative to displayed image offset and scale
-            adj_x1 = int((x1 - self.displayed_image_info["x"]) * scale_x)
-            adj_y1 = int((y1 - self.displayed_image_info["y"]) * scale_y)
-            adj_x2 = int((x2 - self.displayed_image_info["x"]) * scale_x)
-            adj_y2 = int((y2 - self.displayed_image_info["y"]) * scale_y)
-
-            # Save the stroke as an action
-            self.current_stroke.append({
-                "type": "stroke",
-                "coords": [(adj_x1, adj_y1), (adj_x2, adj_y2)],
-                "color": self.brush_color,
-                "width": self.brush_size
-            })
+            # Record the point in image coordinates, skipping ones too close to matter
+            self.stroke_end = self.canvas_to_image(x2, y2)
+            extend_stroke(self.current_stroke, *self.stroke_end)
 
             self.last_draw_pos = (x2, y2)
 
+    def draw_crop_shade(self, start_x, start_y, end_x, end_y):
+        # Remove old overlays
+        for oid in self.crop_overlay_ids:
+            self.canvas.delete(oid)
+        self.crop_overlay_ids.clear()
+
+        # Add new overlay rectangles
+        x1, y1 = min(start_x, end_x), min(start_y, end_y)
+        x2, y2 = max(start_x, end_x), max(start_y, end_y)
+        w, h = self.canvas.winfo_width(), self.canvas.winfo_height()
+
+        self.crop_overlay_ids.extend([
+            self.canvas.create_rectangle(0, 0, w, y1, fill="black", stipple="gray25", width=0),
+            self.canvas.create_rectangle(0, y1, x1, y2, fill="black", stipple="gray25", width=0),
+            self.canvas.create_rectangle(x2, y1, w, y2, fill="black", stipple="gray25", width=0),
+            self.canvas.create_rectangle(0, y2, w, h, fill="black", stipple="gray25", width=0)
+        ])
+
+    def canvas_to_image(self, x, y):
+        # Adjust coords relative to displayed image offset and scale
+        info = self.displayed_image_info
+        scale_x = self.render_size[0] / info["width"]
+        scale_y = self.render_size[1] / info["height"]
+        return int((x - info["x"]) * scale_x), int((y - info["y"]) * scale_y)
+
     def on_mouse_release(self, event):
-        if not self.image: # or not self.rect_id:
+        if not self.image or self.compare_var.get(): # or not self.rect_id:
             return  # Do nothing if no image or rectangle
-        if self.option_var.get() == "Transform" and self.rect_id:
+        if self.option_var.get() == "Tone" and self.current_stroke:
+            points = self.current_stroke["points"]
+            if (points[-2], points[-1]) != self.stroke_end:
+                points.extend(self.stroke_end)
+            self.paint_local(self.current_stroke)
+            self.current_stroke = None
+            self.last_draw_pos = None
+        elif self.option_var.get() == "Transform" and self.rect_id:
             bbox = self.canvas.bbox(self.rect_id)
             # Keep the black crop rectangle visible — do not delete it here
 
@@ -718,14 +3355,16 @@ class PhotoEditor:
                 self.pending_crop_box = (left, upper, right, lower)
                 self.crop_controls.pack(pady=2)
         elif self.option_var.get() == "Extra" and self.drawing_enabled:
-            if self.current_stroke:
-                self.push_state("overlay", {
-                    "action": {
-                        "type": "stroke_group",
-                        "strokes": self.current_stroke
-                    }
-                })
-                self.apply_all_edits()
+            stroke = self.current_stroke
+            if stroke and self.last_draw_pos:
+                # decimation may have dropped the final point, the stroke has to end where the mouse did
+                points = stroke["points"]
+                if (points[-2], points[-1]) != self.stroke_end:
+                    points.extend(self.stroke_end)
+                if len(points) > 2:
+                    self.push_state("overlay", {"action": stroke})
+                    self.apply_all_edits()
+            self.current_stroke = None
             self.last_draw_pos = None
 
     # cropping utility functions
@@ -740,11 +3379,6 @@ class PhotoEditor:
         self.clear_crop_overlay()
         self.apply_all_edits()
 
-    def apply_crop(self, box):
-        if self.image:
-            self.image = self.image.crop(box)
-            self.pre_overlay_image = self.image.copy()
-
     def cancel_crop(self):
         self.pending_crop_box = None
         self.crop_controls.pack_forget()
@@ -769,10 +3403,19 @@ class PhotoEditor:
         })
         self.apply_all_edits()
 
-    def rotate_image(self, angle):
-        if self.image:
-            self.image = self.image.rotate(angle, expand=True)
-            self.pre_overlay_image = self.image.copy()
+    def append_resize(self):
+        if not self.image:
+            return
+        long_edge = max(self.render_size)
+        edge = simpledialog.askinteger("Resize", f"Longest side in pixels (now {long_edge}):",
+                                       minvalue=16, maxvalue=long_edge, parent=self.root)
+        if not edge or edge == long_edge:
+            return
+        self.push_state("resize", {
+            "scale": edge / long_edge
+        })
+        self.apply_all_edits()
+        self.reset_zoom()
 
     def flip_vertical(self):
         self.push_state("flip", {
@@ -786,13 +3429,67 @@ class PhotoEditor:
         })
         self.apply_all_edits()
 
-    def apply_flip(self, dir):
+    # face functions
+
+    def request_faces(self, then=None):
+        # Detection runs once per document in the background, afterwards the boxes are only mapped
+        doc = self.active_document
+        if doc is None:
+            return
+        if doc.faces is not None:
+            if then:
+                then()
+            return
+        if doc.face_job is None:
+            doc.face_job = self.preview_pool.submit(detect_faces_cached, doc.original_image, doc.path)
+        self.root.after(50, self.poll_faces, doc, doc.face_job, then)
+
+    def poll_faces(self, doc, future, then):
+        if not future.done():
+            self.root.after(50, self.poll_faces, doc, future, then)
+            return
+        doc.face_job = None
+        doc.faces = future.result()
+        if doc is self.active_document:
+            self.draw_face_boxes()
+            if then:
+                then()
+
+    def current_faces(self):
+        # Face boxes in render coordinates, after every crop, rotate and flip so far
+        doc = self.active_document
+        if doc is None or doc.faces is None:
+            return []
+        return map_faces(doc.faces, self.original_image.size, self.history_stack)
+
+    def toggle_face_boxes(self):
+        if self.show_faces_var.get():
+            self.request_faces()
+        self.draw_face_boxes()
+
+    def draw_face_boxes(self):
+        self.canvas.delete("faces")
+        if not self.image or not self.show_faces_var.get() or self.compare_var.get():
+            return
+        x, y, zoom = self.canvas_offset[0], self.canvas_offset[1], self.zoom_factor
+        for left, upper, right, lower in self.current_faces():
+            self.canvas.create_rectangle(x + left * zoom, y + upper * zoom, x + right * zoom, y + lower * zoom,
+                                         outline="yellow", width=2, tags="faces")
+
+    def auto_crop_faces(self):
         if self.image:
-            if dir == "vertical":
-                self.image = self.image.transpose(Image.FLIP_TOP_BOTTOM)
-            elif dir == "horizontal":
-                self.image = self.image.transpose(Image.FLIP_LEFT_RIGHT)
-            self.pre_overlay_image = self.image.copy()
+            self.request_faces(then=self.apply_face_crop)
+
+    def apply_face_crop(self):
+        faces = self.current_faces()
+        if not faces:
+            messagebox.showinfo("Auto-Crop", "No faces found in this image.")
+            return
+        box = face_crop_box(faces, self.render_size)
+        if box == (0, 0) + tuple(self.render_size):
+            return  # the faces already fill the picture
+        self.pending_crop_box = box
+        self.append_crop()
 
     # filter functions
 
@@ -818,6 +3515,48 @@ class PhotoEditor:
         self.filter_states["blur"] = not self.filter_states["blur"]
         self.append_filter()
 
+    def apply_filter_combination(self, filter_states):
+        if not self.image or filter_states == self.filter_states:
+            return
+        self.filter_states = copy.deepcopy(filter_states)
+        self.append_filter()
+
+    def current_gallery_key(self):
+        # Filter entries don't change what the previews start from, anything else might. The key
+        # holds the objects themselves, compared by identity: it keeps them alive, so an undone
+        # entry's id can't be reused by a new one while the key is around
+        return (self.original_image,) + tuple(i for i in self.history_stack if i["type"] != "filter")
+
+    def refresh_filter_gallery(self):
+        if not self.image or self.prefilter_image is None:
+            return
+        self.filter_gallery.highlight(self.filter_states)
+        key = self.current_gallery_key()
+        if same_objects(key, self.gallery_key):
+            return
+        self.gallery_key = key
+
+        # one small proxy shared by every preview
+        proxy = self.prefilter_image.copy()
+        proxy.thumbnail((GALLERY_PROXY_SIZE, GALLERY_PROXY_SIZE))
+        scale = proxy.size[0] / self.render_size[0]
+        futures = [self.preview_pool.submit(render_filter_preview, proxy, states, scale, self.brightness, self.contrast)
+                   for states in FILTER_COMBINATIONS]
+        self.gallery_jobs = (key, futures)
+        self.root.after(10, self.poll_filter_gallery)
+
+    def poll_filter_gallery(self):
+        if self.gallery_jobs is None:
+            return
+        key, futures = self.gallery_jobs
+        if not same_objects(key, self.gallery_key):
+            return  # superseded by a newer refresh
+        if not all(future.done() for future in futures):
+            self.root.after(10, self.poll_filter_gallery)
+            return
+        self.gallery_jobs = None
+        self.filter_gallery.show([future.result() for future in futures])
+
     def update_filter_button_colors(self):
         for name, button in self.filter_buttons.items():
             if self.filter_states.get(name):
@@ -829,32 +3568,7 @@ class PhotoEditor:
         if not hasattr(self, 'original_image') or self.original_image is None:
             return
 
-        img = self.image.copy()
-
-        if self.filter_states["grayscale"]:
-            img = img.convert("L").convert("RGB")
-
-        if self.filter_states["sepia"]:
-            pixels = img.load()
-            for py in range(img.size[1]):
-                for px in range(img.size[0]):
-                    r, g, b = pixels[px, py]
-                    tr = int(0.393 * r + 0.769 * g + 0.189 * b)
-                    tg = int(0.349 * r + 0.686 * g + 0.168 * b)
-                    tb = int(0.272 * r + 0.534 * g + 0.131 * b)
-                    pixels[px, py] = (min(255, tr), min(255, tg), min(255, tb))
-
-        if self.filter_states["invert"]:
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img = ImageOps.invert(img)
-
-        if self.filter_states["blur"]:
-            img = img.filter(ImageFilter.GaussianBlur(10))
-
-        # print(self.history_stack[-1])
-
-        self.image = img
+        self.image = apply_filters(self.image, self.filter_states)
 
     # tone functions
 
@@ -867,27 +3581,21 @@ class PhotoEditor:
 
     def apply_tone_adjustments(self, event=None):
         if self.image:
-            self.image = ImageEnhance.Brightness(self.image).enhance(self.brightness)
-            self.image = ImageEnhance.Contrast(self.image).enhance(self.contrast)
+            self.image, stats = apply_tone(self.image, self.brightness, self.contrast)
+            return stats
 
     def preview_tone_adjustments(self, event=None):
         if self.image:
             brightness = float(self.brightness_slider.get())
             contrast = float(self.contrast_slider.get())
 
-            img = ImageEnhance.Brightness(self.original_image).enhance(brightness)
-            img = ImageEnhance.Contrast(img).enhance(contrast)
-
-            self.image = img
+            self.image, _ = apply_tone(self.original_image, brightness, contrast)
             self.display_image()
 
     # extra functions
 
     def toggle_drawing(self):
         if self.drawing_var.get():
-            # Save a backup before drawing starts once
-            if not hasattr(self, 'pre_overlay_image'):
-                self.pre_overlay_image = self.image.copy()
             self.drawing_enabled = not self.drawing_enabled
             self.text_mode = False  # disable text mode if drawing enabled
             self.last_draw_pos = None
@@ -900,10 +3608,121 @@ class PhotoEditor:
     def update_brush_size(self, val):
         self.brush_size = int(float(val))
 
+    # local adjustment functions
+
+    def toggle_local_paint(self):
+        self.canvas.config(cursor="circle" if self.local_paint_var.get() else "arrow")
+
+    def new_local_layer(self):
+        # the next stroke starts a layer of its own, with the sliders as they are
+        self.local_layer = None
+
+    def active_local_entry(self):
+        # The current layer's latest entry, as long as nothing that changes pixels came after it
+        for entry in reversed(self.history_stack):
+            if entry["type"] in STAGE_TYPES:
+                if entry["type"] == "local" and entry["data"]["layer"] == self.local_layer:
+                    return entry
+                return None
+        return None
+
+    def paint_local(self, stroke):
+        # Each stroke is a history entry of its own, undo takes back one stroke at a time
+        entry = self.active_local_entry()
+        if entry is None:
+            self.local_layer = next(self.local_layer_ids)
+            mask = SparseMask(self.render_size)
+        else:
+            mask = entry["data"]["mask"]
+        mask, box = mask.painted(stroke)
+        if box is None:
+            self.display_image()  # clears the trail
+            return
+        self.push_state("local", {
+            "layer": self.local_layer,
+            "mask": mask,
+            "brightness": round(float(self.local_brightness_slider.get()), 3),
+            "contrast": round(float(self.local_contrast_slider.get()), 3)
+        })
+        self.update_local_region(box)
+
+    def append_local_tone(self, event=None):
+        entry = self.active_local_entry()
+        if entry is None:
+            return  # the values are for the next layer
+        self.push_state("local", dict(entry["data"],
+                                      brightness=round(float(self.local_brightness_slider.get()), 3),
+                                      contrast=round(float(self.local_contrast_slider.get()), 3)))
+        self.update_local_region(entry["data"]["mask"].bbox())
+
+    def update_local_region(self, box):
+        """
+        Renders again only box (render coordinates) after the top local adjustment changed.
+        Global contrast keeps the mean of the last full render, a small stroke hardly moves it.
+        """
+        if self.render_stale or (self.contrast != 1.0 and self.contrast_mean is None):
+            self.apply_all_edits()  # zoomed in that is a region render anyway
+            return
+        # the blur carries the change past the painted box, so that margin is rendered again too
+        pad = filter_padding(self.filter_states)
+        box = (max(0, box[0] - pad), max(0, box[1] - pad),
+               min(self.render_size[0], box[2] + pad), min(self.render_size[1], box[3] + pad))
+        source, history = self.render_source()
+        final = render_region(source, history, box, self.filter_states, self.brightness, self.contrast,
+                              self.contrast_mean)
+        if self.image is self.prefilter_image:
+            self.image = self.prefilter_image = self.image.copy()
+        else:
+            prefilter = render_region(source, history, box, dict.fromkeys(self.filter_states, False), 1.0, 1.0)
+            # copies, the old renders may be shared with the document or on their way to the cache
+            self.prefilter_image = self.prefilter_image.copy()
+            self.prefilter_image.paste(prefilter, box[:2])
+            self.image = self.image.copy()
+        self.image.paste(final, box[:2])
+        self.display_image()
+        self.store_active_document()
+        self.mark_render_changed()
+
+    # color replacement
+
+    def activate_color_pick(self):
+        self.color_pick_mode = True
+        self.text_mode = False
+        self.canvas.config(cursor="crosshair")
+
+    def pick_color(self, x, y):
+        # Sampled before filters and tone, which is what the color entry gets matched against
+        self.color_pick_mode = False
+        self.canvas.config(cursor="pencil" if self.drawing_enabled else "arrow")
+        x, y = self.canvas_to_image(x, y)
+        img = self.prefilter_image
+        # while zoomed in prefilter_image is the proxy render, smaller than the render itself
+        x = int(x * img.size[0] / self.render_size[0])
+        y = int(y * img.size[1] / self.render_size[1])
+        if not (0 <= x < img.size[0] and 0 <= y < img.size[1]):
+            return
+        r, g, b = img.getpixel((x, y))
+        self.replace_from_var.set(f"#{r:02x}{g:02x}{b:02x}")
+
+    def append_color(self):
+        if not self.image:
+            return
+        try:
+            source = ImageColor.getrgb(self.replace_from_var.get().strip())[:3]
+            target = ImageColor.getrgb(self.replace_to_var.get().strip())[:3]
+        except ValueError:
+            messagebox.showerror("Replace Color", "Colors have to be names like red or hex like #ff0000.")
+            return
+        self.push_state("color", {
+            "source": source,
+            "target": target,
+            "tolerance": round(float(self.replace_tolerance_slider.get()), 1),
+            "softness": round(float(self.replace_softness_slider.get()), 1),
+            "space": self.replace_space_var.get()
+        })
+        self.apply_all_edits()
+
     def activate_text_mode(self):
-        # Save backup before text if not already defined through drawing
-        if not hasattr(self, 'pre_overlay_image'):
-            self.pre_overlay_image = self.image.copy()
         self.text_mode = True
         if self.drawing_var.get():
             self.drawing_var.set(False)
@@ -940,95 +3759,322 @@ class PhotoEditor:
         self.canvas.config(cursor="arrow")
         return "break"
 
-    def reapply_overlay_actions(self):
-        if not hasattr(self, 'pre_overlay_image') or self.pre_overlay_image is None:
-            return
-
-        # Start from a clean image (before overlays)
-        self.image = self.pre_overlay_image.copy()
-        draw = ImageDraw.Draw(self.image)
-
-        for entry in self.history_stack:
-            if entry["type"] != "overlay":
-                continue
-
-            action = entry["data"]["action"]
-
-            # if action["type"] == "stroke":
-                # draw.line(action["coords"], fill=action["color"], width=action["width"])
-
-            if action["type"] == "stroke_group":
-                for stroke in action["strokes"]:
-                    draw.line(stroke["coords"], fill=stroke["color"], width=stroke["width"])
-
-            elif action["type"] == "text":
-                try:
-                    from PIL import ImageFont
-                    font = ImageFont.truetype("arial.ttf", action["font_size"]*4)
-                except:
-                    font = None  # Use default if arial.ttf is not found
-                draw.text(action["position"], action["text"], font=font, fill=action["color"])
-
-    def apply_all_edits(self):
-        self.image = self.original_image.copy()
+    def load_edit_state(self):
+        # Filter and tone entries only set state, the last one of each kind wins
         self.reset_filter_states()
         self.brightness = 1.0
         self.contrast = 1.0
         for i in self.history_stack:
-            if i["type"] == "crop":
-                self.apply_crop(i["data"]["box"])
-            elif i["type"] == "rotate":
-                self.rotate_image(i["data"]["angle"])
-            elif i["type"] == "flip":
-                self.apply_flip(i["data"]["direction"])
-            elif i["type"] == "filter":
+            if i["type"] == "filter":
                 self.filter_states = copy.deepcopy(i["data"]["filters"])
             elif i["type"] == "tone":
                 self.brightness = float(i["data"]["brightness"])
                 self.contrast = float(i["data"]["contrast"])
-            elif i["type"] == "overlay":
-                self.reapply_overlay_actions()
+
+    def apply_all_edits(self, full=False):
+        self.load_edit_state()
+        self.render_size = history_size(self.original_image.size, self.history_stack)
+        self.viewport_cache = None
+        self.render_job = None
+        canvas_width, canvas_height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if not full and canvas_width > 1 and self.viewport_worthwhile(canvas_width, canvas_height):
+            # zoomed in: the proxy stands in for the whole image, display_image renders what is visible
+            proxy, scale = self.document_proxy()
+            self.prefilter_image, _, stats = render_proxy(proxy, scale, self.history_stack, self.filter_states,
+                                                          self.brightness, self.contrast)
+            self.contrast_mean = stats.get("contrast_mean")
+            self.render_stale = True
+        elif not full and self.render_workers is not None and self.offload_render():
+            stats = self.render_job[2]  # the proxy's, until the worker's replace them
+            self.render_stale = True
+        else:
+            stats = self.render_full()
+            self.contrast_mean = stats.get("contrast_mean") if stats else None
+            self.render_stale = False
         self.update_filter_button_colors()
-        self.update_filtered_image()
-        self.apply_tone_adjustments()
         self.brightness_slider.set(self.brightness)
         self.contrast_slider.set(self.contrast)
         self.display_image()
+        self.store_active_document()
+        self.mark_render_changed(stats)
+
+    def offload_render(self):
+        """
+        Hands the render to a worker process when it is big and not in the render cache. The
+        view shows the finished proxy until poll_worker_render installs the result. Returns
+        False when the render is better done here.
+        """
+        source, history = self.render_source()
+        if source.size[0] * source.size[1] < WORKER_RENDER_MIN_PIXELS or source.mode not in SHAREABLE_MODES:
+            return False
+        doc = self.active_document
+        if doc.digest is None:
+            doc.digest = source_digest(self.original_image)
+        keys = stage_cache_keys(doc.digest, self.history_stack)
+        final_key = final_cache_key(keys[-1], self.filter_states, self.brightness, self.contrast)
+        if os.path.exists(self.render_cache.path(final_key)):
+            return False  # one read, render_full does that quicker
+        # the worker reads the longest cached prefix itself and replays only what follows it
+        done = self.render_cache.prefix_length(keys)
+        prefix = None
+        if done:
+            stage_entries = [i for i in plan_history(self.history_stack) if i["type"] in STAGE_TYPES]
+            prefix = (self.render_cache.path(keys[done]), stage_entries[done:])
+
+        shared = self.shared_source
+        if shared is None or shared.image is not source:
+            if shared is not None:
+                self.retire_shared_source()
+            shared = self.shared_source = SharedImage(source)
+        future = self.render_workers.submit(worker_render, shared.handle, history, self.filter_states,
+                                            self.brightness, self.contrast, _backend_choices, prefix)
+        shared.jobs += 1
+        self.worker_jobs.append((future, shared))
+
+        proxy, scale = self.document_proxy()
+        self.prefilter_image, preview, stats = render_proxy(proxy, scale, self.history_stack, self.filter_states,
+                                                            self.brightness, self.contrast)
+        self.render_job = (future, preview, stats)
+        self.root.after(WORKER_POLL_MS, self.poll_worker_render, future, keys, final_key, time.perf_counter())
+        return True
+
+    def poll_worker_render(self, future, keys, final_key, started):
+        if not future.done():
+            self.root.after(WORKER_POLL_MS, self.poll_worker_render, future, keys, final_key, started)
+            return
+        result = self.collect_worker_job(future)
+        if self.render_job is None or self.render_job[0] is not future:
+            return  # the edits moved on while it rendered
+        if result is None:
+            self.apply_all_edits(full=True)  # the worker failed, render here instead
+            return
+        prefilter, image, stats = result
+        self.install_worker_render(prefilter, image, stats)
+        if (time.perf_counter() - started) * 1000 > RENDER_CACHE_MIN_MS:
+            self.preview_pool.submit(self.render_cache.put, keys[-1], prefilter)
+            if image is not prefilter:
+                self.preview_pool.submit(self.render_cache.put, final_key, image)
+
+    def finish_worker_render(self, future):
+        # Waits for the render the view is showing a proxy for, when every pixel is needed now
+        result = self.collect_worker_job(future)
+        if result is None:
+            self.apply_all_edits(full=True)
+            return
+        self.install_worker_render(*result)
+
+    def collect_worker_job(self, future):
+        # Waits for a job's results (None if it failed or was collected already), frees its blocks
+        for job in self.worker_jobs:
+            if job[0] is future:
+                break
+        else:
+            return None
+        self.worker_jobs.remove(job)
+        shared = job[1]
+        shared.jobs -= 1
+        if shared.retired and not shared.jobs:
+            shared.close()
+        try:
+            prefilter_handle, image_handle, stats = future.result()
+        except Exception as e:
+            # the caller renders in this process instead, so the user sees nothing of it
+            logger.warning("Worker render failed, rendering in the editor instead", exc_info=True)
+            if isinstance(e, BrokenExecutor):
+                self.render_workers = None  # a worker died, later renders stay in this process
+            return None
+        prefilter = take_result(prefilter_handle)
+        image = prefilter if image_handle == prefilter_handle else take_result(image_handle)
+        return prefilter, image, stats
+
+    def install_worker_render(self, prefilter, image, stats):
+        self.prefilter_image = prefilter
+        self.image = image
+        self.contrast_mean = stats.get("contrast_mean") if stats else None
+        self.render_stale = False
+        self.render_job = None
+        self.display_image()
+        self.store_active_document()
+        self.mark_render_changed(stats)
+
+    def retire_shared_source(self):
+        # Frees the shared source now, or once the worker renders still reading it are done
+        shared = self.shared_source
+        self.shared_source = None
+        if shared is None:
+            return
+        shared.retired = True
+        if not shared.jobs:
+            shared.close()
+
+    def shutdown_render_workers(self):
+        self.render_job = None
+        if self.render_workers is not None:
+            self.render_workers.shutdown(wait=True, cancel_futures=True)
+            self.render_workers = None
+        for future, _ in list(self.worker_jobs):
+            self.collect_worker_job(future)
+        self.retire_shared_source()
+
+    def render_source(self):
+        # The image the replay starts from and the planned history left to apply to it
+        planned = plan_history(self.history_stack)
+        if planned and planned[0]["type"] == "resize":
+            return self.reduced_source(planned[0]), planned[1:]
+        return self.original_image, planned
+
+    def reduced_source(self, entry):
+        # The original at the leading resize's size, kept on the document for the next render
+        doc = self.active_document
+        size = geometry_size(self.original_image.size, entry)
+        if doc.reduced is not None and doc.reduced[0] == size:
+            return doc.reduced[1]
+        img = None
+        if doc.path and entry["data"]["scale"] <= 0.5:
+            # JPEGs decode at a fraction of the size faster than the full original resizes
+            try:
+                st = os.stat(doc.path)
+                if (st.st_mtime_ns, st.st_size) == doc.path_stat:
+                    img = decode_reduced(doc.path, size)
+            except OSError:
+                img = None
+        if img is None:
+            img = apply_geometry(self.original_image, entry)
+        doc.reduced = (size, img)
+        return img
+
+    def render_full(self):
+        # Sets self.image and self.prefilter_image, reading whatever an earlier render left in the cache
+        if not self.history_stack:
+            self.image = self.prefilter_image = self.original_image
+            return None
+        doc = self.active_document
+        if doc.digest is None:
+            doc.digest = source_digest(self.original_image)
+        planned = plan_history(self.history_stack)
+        keys = stage_cache_keys(doc.digest, planned)
+        stage_entries = [i for i in planned if i["type"] in STAGE_TYPES]
+
+        # the longest cached prefix, then only the entries after it
+        started = time.perf_counter()
+        done, stage = self.render_cache.longest_prefix(keys)
+        if stage is None and stage_entries and stage_entries[0]["type"] == "resize":
+            stage = self.reduced_source(stage_entries[0])
+            done = 1
+        self.prefilter_image = render_stage(stage or self.original_image, stage_entries[done:])
+        if done < len(stage_entries) and (time.perf_counter() - started) * 1000 > RENDER_CACHE_MIN_MS:
+            self.preview_pool.submit(self.render_cache.put, keys[-1], self.prefilter_image)
+
+        if not any(self.filter_states.values()) and self.brightness == 1.0 and self.contrast == 1.0:
+            self.image = self.prefilter_image
+            return None
+        final_key = final_cache_key(keys[-1], self.filter_states, self.brightness, self.contrast)
+        cached = self.render_cache.get(final_key)
+        if cached is not None:
+            self.image = cached
+            return None
+
+        started = time.perf_counter()
+        self.image = self.prefilter_image
+        self.update_filtered_image()
+        stats = self.apply_tone_adjustments()
+        if (time.perf_counter() - started) * 1000 > RENDER_CACHE_MIN_MS:
+            self.preview_pool.submit(self.render_cache.put, final_key, self.image)
+        return stats
 
     def revert_to_original(self):
         if self.image and hasattr(self, 'original_image'):
             self.image = self.original_image.copy()
-            self.pre_overlay_image = self.image.copy()
+            self.prefilter_image = self.image
+            self.render_size = self.image.size
+            self.render_stale = False
+            self.render_job = None
             self.history_stack.clear()
             self.history_redo_stack.clear()
             self.display_image()
+            self.mark_render_changed()
 
     # save & exit functions
 
     def save_image(self):
+        self.ensure_full_render()
         if self.image:
             save_path = filedialog.asksaveasfilename(defaultextension=".jpg",
                                                      filetypes=[("JPEG", "*.jpg"), ("PNG", "*.png")])
             if save_path:
-                self.image.save(save_path)
+                export_image(self.image, self.active_document.alpha, self.history_stack, save_path).save(save_path)
                 messagebox.showinfo("Saved", f"Image saved to {save_path}")
 
+    def export_web_sizes(self):
+        if not self.image:
+            return
+        self.ensure_full_render()
+        folder = filedialog.askdirectory(title="Export web sizes to")
+        if not folder:
+            return
+        name = self.active_document.name if self.active_document else "image"
+        stem = os.path.splitext(name)[0].replace(" ", "_")
+        # export runs off the Tk thread, the render is never modified in place so it can be shared
+        future = self.preview_pool.submit(export_sizes, self.image, folder, stem)
+        self.root.config(cursor="watch")
+        self.root.after(50, self.poll_export, future, time.perf_counter())
+
+    def poll_export(self, future, started):
+        if not future.done():
+            self.root.after(50, self.poll_export, future, started)
+            return
+        self.root.config(cursor="")
+        try:
+            paths = future.result()
+        except OSError as e:
+            messagebox.showerror("Export failed", str(e))
+            return
+        elapsed = time.perf_counter() - started
+        messagebox.showinfo("Exported", f"{len(paths)} sizes exported in {elapsed:.1f} s to\n"
+                                        f"{os.path.dirname(paths[0])}")
+
     def exit_program(self):
+        self.ensure_full_render()
         if self.image:
             if messagebox.askyesno("Save", "Do you want to save your changes before exiting?"):
                 self.save_image()
-            self.image.save("last_session_image.jpg")
+            self.image.save(LAST_SESSION_PATH)
+        self.shutdown_render_workers()
         self.root.destroy()
 
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--benchmark-live-look":
+        # python main.py --benchmark-live-look video.mp4
+        for states in FILTER_COMBINATIONS:
+            result = measure_live_look_fps(sys.argv[2], states, brightness=1.2, contrast=1.2)
+            print(f"{filter_combination_label(states):24} {result['size']} {result['fps']:.0f} fps")
+        sys.exit()
+    if len(sys.argv) == 2 and sys.argv[1] == "--autotune-backends":
+        for op, results in autotune_backends().items():
+            for r in results:
+                print(f"{op:10} {r['pixels'] / 1e6:5.1f} MP  pillow {r['pillow_ms']:8.1f} ms  "
+                      f"opencv {r['opencv_ms']:8.1f} ms  diff {r['max_diff']:3}/{r['mean_diff']:.3f}  -> {r['backend']}")
+        sys.exit()
+    if len(sys.argv) == 2 and sys.argv[1] == "--check-region-render":
+        worst = check_region_render()
+        print(f"Region renders against the full render: largest difference {worst}")
+        sys.exit(1 if worst else 0)
+    if len(sys.argv) == 3 and sys.argv[1] == "--benchmark-burst":
+        result = measure_burst_fps(sys.argv[2])
+        print(f"Burst capture: {result['frames']} frames scored at {result['fps']:.0f} fps")
+        sys.exit()
+
+    # python main.py --startup-report prints how long the window took to come up
     root = tk.Tk()
-    app = PhotoEditor(root)
+    app = PhotoEditor(root, report_startup=sys.argv[1:] == ["--startup-report"])
 
     def on_closing():
+        app.ensure_full_render()
         if app.image:
             # Save to a hidden temporary file or a known file path
-            app.image.save("last_session_image.jpg")
+            app.image.save(LAST_SESSION_PATH)
+        app.shutdown_render_workers()
         root.destroy()
 
     root.protocol("WM_DELETE_WINDOW", on_closing)
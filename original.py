@@ -1,6 +1,102 @@
 from PIL import Image
+from PIL import ImageFile
 from PIL import ImageFilter
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import hashlib
+import json
+import os
+import threading
+
+from colortools import replace_color
+
+URL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".photoeditor", "cache", "urls")
+CHUNK_SIZE = 64 * 1024
+
+
+def show_info(image):
+    print("this is the file type and the size of your selected image")
+    print(image.format, image.size)
+
+
+def atomic_write(path, data):
+    # write to a temporary file and rename it into place, so a crash never leaves half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tempPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tempPath, "w" if isinstance(data, str) else "wb") as f:
+        f.write(data)
+    os.replace(tempPath, path)
+
+
+def open_cached(path):
+    # the cached image, or None if it can't be read any more
+    try:
+        cached = Image.open(path)
+        cached.load()
+        return cached
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def load_url(url, cache_dir=URL_CACHE_DIR, on_header=show_info):
+    # downloads are kept in cache_dir and only fetched again if the server says they changed
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    dataPath = os.path.join(cache_dir, key + ".img")
+    metaPath = os.path.join(cache_dir, key + ".json")
+
+    headers = {}
+    meta = None
+    if os.path.exists(dataPath) and os.path.exists(metaPath):
+        try:
+            with open(metaPath) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}  # unreadable, fetch without validators
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as e:
+        if e.code != 304 or meta is None:
+            raise
+        # not modified, the cached copy is still good if it can be read
+        cached = open_cached(dataPath)
+        if cached is not None:
+            on_header(cached)
+            return cached
+        response = urlopen(Request(url))
+
+    # decode while the bytes arrive, the header is reported as soon as it has been parsed
+    parser = ImageFile.Parser()
+    chunks = []
+    announced = False
+    with response:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            chunks.append(chunk)
+            if not announced and parser.image is not None:
+                on_header(parser.image)
+                announced = True
+        etag = response.headers.get("ETag")
+        lastModified = response.headers.get("Last-Modified")
+    image = parser.close()
+    if not announced:
+        on_header(image)
+
+    if etag or lastModified:
+        # without a validator there would be no way to tell when the copy goes stale.
+        # The old validators go first and the new ones last, so they never vouch for other bytes
+        if os.path.exists(metaPath):
+            os.remove(metaPath)
+        atomic_write(dataPath, b"".join(chunks))
+        atomic_write(metaPath, json.dumps({"url": url, "etag": etag, "last_modified": lastModified}))
+    return image
 
 
 def change_type(oldImage):
@@ -38,7 +134,9 @@ def resize(oldImage):
         try:
             width = int(input("What width should your image have?"))
             heigth = int(input("What heigth should your image have?"))
-            resized = oldImage.resize((width, heigth))
+            # a JPEG that hasn't been decoded yet (resize as the first edit) decodes at 1/2, 1/4 or 1/8 scale
+            oldImage.draft(oldImage.mode, (width, heigth))
+            resized = oldImage.resize((width, heigth), reducing_gap=2.0)
             resized.show()
             return resized
         except:
@@ -55,13 +153,10 @@ def change_color(oldImage):
             x2 = int(input("Type in the value of the red band for the color you want to change it to"))
             y2 = int(input("Type in the value of the green band for the color you want to change it to"))
             z2 = int(input("Type in the value of the blue band for the color you want to change it to"))
-            pixels = oldImage.load()  # create the pixel map
-            for i in range(oldImage.size[0]):  # for every pixel:
-                for j in range(oldImage.size[1]):
-                    if pixels[i, j] == (x1, y1, z1):
-                        # change to black if not red
-                        pixels[i, j] = (x2, y2, z2)
-            changed = oldImage
+            tolerance = input("How close does a color have to be to count? (0 for only that exact color, up to 441)")
+            tolerance = float(tolerance) if tolerance.strip() else 0.0
+            # every pixel at once instead of a python loop over each one
+            changed = replace_color(oldImage, (x1, y1, z1), (x2, y2, z2), tolerance)
             changed.show()
             return changed
         except:
@@ -90,35 +185,35 @@ def apply_filter(oldImage):
             continue
 
 
-kind = input("Do you have your picture saved locally or from the internet?")
-if kind == "locally":
-    name = input("type in the name of your file (eg. filename.type")
-    im = Image.open(name)
-elif kind == "internet":
-    url = input("copy the url of your selected picture here:")
-    im = Image.open(urlopen(url))
-else:
-    print("invalid input")
-print("this is the file type and the size of your selected image")
-print(im.format, im.size)
-
-while True:
-    inp = input("If you want to edit your image type 'edit', if you want to save your file type 'save'")
-    if inp == 'edit':
-        edit = input("Do you want to 'rotate', 'resize', 'apply filter' or 'change color'?")
-        if edit == "resize":
-            im = resize(im)
-            continue
-        if edit == "rotate":
-            im = rotate(im)
-            continue
-        if edit == "apply filter":
-            im = apply_filter(im)
-            continue
-        if edit == "change color":
-            im = change_color(im)
-            continue
-    elif inp == 'save':
-        change_type(im)
-        break
-im.show()
\ No newline at end of file
+if __name__ == "__main__":
+    kind = input("Do you have your picture saved locally or from the internet?")
+    if kind == "locally":
+        name = input("type in the name of your file (eg. filename.type")
+        im = Image.open(name)
+        show_info(im)
+    elif kind == "internet":
+        url = input("copy the url of your selected picture here:")
+        im = load_url(url)
+    else:
+        print("invalid input")
+
+    while True:
+        inp = input("If you want to edit your image type 'edit', if you want to save your file type 'save'")
+        if inp == 'edit':
+            edit = input("Do you want to 'rotate', 'resize', 'apply filter' or 'change color'?")
+            if edit == "resize":
+                im = resize(im)
+                continue
+            if edit == "rotate":
+                im = rotate(im)
+                continue
+            if edit == "apply filter":
+                im = apply_filter(im)
+                continue
+            if edit == "change color":
+                im = change_color(im)
+                continue
+        elif inp == 'save':
+            change_type(im)
+            break
+    im.show()